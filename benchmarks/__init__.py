@@ -0,0 +1,6 @@
+"""
+Package: benchmarks
+Performance benchmarks for the promotions service
+
+Each module can be run on its own, e.g. `python -m benchmarks.serialize`
+"""
@@ -0,0 +1,258 @@
+"""
+Synthetic Promotion Dataset Generator
+
+Generates large numbers of realistic Promotions and writes them as CSV or
+NDJSON, or loads them straight into the promotion table with COPY:
+
+- products are picked with a Zipf-like skew, so a few popular products
+  have many Promotions and most have a handful
+- date windows start anywhere in a period and last from a day to a
+  quarter, so they overlap; some have no end date
+- types follow a configurable mix, with dollar values for VALUE and
+  round percentages for PERCENTAGE Promotions
+
+Names come from a pool built with tests.factories.PromotionFactory. The
+same --seed always gives the same rows.
+
+NDJSON lines are in the JSON format of the API, ready for POST
+/promotions/bulk; CSV rows are in the column order COPY uses.
+
+Usage:
+  python -m benchmarks.dataset --rows 1000000 [--products 50000] [--skew 0.8]
+      [--types VALUE=60,PERCENTAGE=35,UNKNOWN=5] [--ongoing 0.8] [--open-ended 0.05]
+      [--start 2022-01-01] [--days 365] [--seed 0]
+      (--format csv|ndjson --output FILE|- | --load [--truncate])
+"""
+import argparse
+import bisect
+import csv
+import io
+import itertools
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import factory
+from sqlalchemy import text
+
+from service import app
+from service.models import Promotion, Type, db
+from tests.factories import PromotionFactory
+
+# the columns written by COPY, in CSV order
+COLUMNS = ("name", "start_date", "end_date", "type", "value", "ongoing", "product_id")
+# typical lengths of a Promotion in days, with their weights
+DURATIONS = ((1, 10), (3, 15), (7, 30), (14, 20), (30, 15), (90, 10))
+# rows generated, written or copied at a time
+CHUNK_SIZE = 50000
+API_DATE_FORMAT = "%m-%d-%Y %H:%M:%S +0000"
+
+
+def parse_types(value):
+    """Returns the Types and weights of a mix such as VALUE=60,PERCENTAGE=40"""
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        try:
+            mix[Type[name.strip().upper()]] = float(weight)
+        except (KeyError, ValueError) as error:
+            raise argparse.ArgumentTypeError("bad type weight: {}".format(item)) from error
+    return mix
+
+
+def parse_date(value):
+    """Returns the naive UTC datetime of a YYYY-MM-DD date"""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError as error:
+        raise argparse.ArgumentTypeError("dates look like 2022-01-31: {}".format(value)) from error
+
+
+def name_pool(size, seed):
+    """Returns `size` Promotion names made by PromotionFactory"""
+    factory.random.reseed_random(seed)
+    suffixes = ("Sale", "Deal", "Special", "Clearance", "Offer")
+    return [
+        "{} {}".format(promotion.name, suffixes[index % len(suffixes)])[:63]
+        for index, promotion in enumerate(PromotionFactory.build_batch(size))
+    ]
+
+
+class Generator:
+    """
+    Makes rows of Promotions with skewed products and overlapping windows
+
+    A row is a tuple of the COLUMNS values, with naive UTC datetimes and
+    the Type name.
+    """
+
+    def __init__(self, products, skew, types, ongoing, open_ended, start, days, names, seed):
+        self.random = random.Random(seed)
+        self.names = names
+        self.ongoing = ongoing
+        self.open_ended = open_ended
+        self.start = start
+        self.seconds = days * 24 * 3600
+        # product ranks 1..n weigh 1/rank**skew; ids are shuffled so that
+        # the popular products are not simply the lowest ids
+        self.product_ids = list(range(1, products + 1))
+        self.random.shuffle(self.product_ids)
+        self.product_weights = list(itertools.accumulate(
+            1.0 / rank ** skew for rank in range(1, products + 1)
+        ))
+        self.types = list(types)
+        self.type_weights = list(itertools.accumulate(types.values()))
+        self.durations = [days for days, _ in DURATIONS]
+        self.duration_weights = list(itertools.accumulate(weight for _, weight in DURATIONS))
+
+    def pick_product(self):
+        """Returns a product id, popular ones more often"""
+        total = self.product_weights[-1]
+        index = bisect.bisect(self.product_weights, self.random.random() * total)
+        return self.product_ids[min(index, len(self.product_ids) - 1)]
+
+    def rows(self, count):
+        """Yields `count` rows"""
+        choices = self.random.choices
+        for _ in range(count):
+            start_date = self.start + timedelta(seconds=self.random.randrange(self.seconds))
+            if self.random.random() < self.open_ended:
+                end_date = None
+            else:
+                days = choices(self.durations, cum_weights=self.duration_weights)[0]
+                end_date = start_date + timedelta(days=days, seconds=-1)
+            promotion_type = choices(self.types, cum_weights=self.type_weights)[0]
+            if promotion_type is Type.PERCENTAGE:
+                value = float(self.random.randrange(5, 95, 5))
+            else:
+                value = round(self.random.uniform(1.0, 100.0), 2)
+            yield (
+                self.random.choice(self.names),
+                start_date,
+                end_date,
+                promotion_type.name,
+                value,
+                self.random.random() < self.ongoing,
+                self.pick_product(),
+            )
+
+
+def write_csv(rows, output):
+    """Writes `rows` as CSV in the COPY column order, with a header"""
+    writer = csv.writer(output)
+    writer.writerow(COLUMNS)
+    write_csv_rows(rows, writer)
+
+
+def write_csv_rows(rows, writer):
+    """Writes `rows` without a header; datetimes in ISO format, NULL as empty"""
+    for name, start_date, end_date, promotion_type, value, ongoing, product_id in rows:
+        writer.writerow((
+            name,
+            start_date.isoformat(" "),
+            "" if end_date is None else end_date.isoformat(" "),
+            promotion_type,
+            value,
+            "t" if ongoing else "f",
+            product_id,
+        ))
+
+
+def write_ndjson(rows, output):
+    """Writes `rows` as one API JSON object per line"""
+    for name, start_date, end_date, promotion_type, value, ongoing, product_id in rows:
+        output.write(json.dumps({
+            "name": name,
+            "start_date": start_date.strftime(API_DATE_FORMAT),
+            "end_date": None if end_date is None else end_date.strftime(API_DATE_FORMAT),
+            "type": promotion_type,
+            "value": value,
+            "ongoing": ongoing,
+            "product_id": product_id,
+        }))
+        output.write("\n")
+
+
+def load(rows, count, truncate=False):
+    """Copies `rows` into the promotion table in chunks and returns the rows copied
+
+    Everything is copied in one transaction, so a failed load leaves the
+    table as it was, and the table is analyzed afterwards.
+    """
+    statement = "COPY promotion ({}) FROM STDIN WITH (FORMAT csv)".format(", ".join(COLUMNS))
+    copied = 0
+    with app.app_context():
+        Promotion.create_schema()
+        cursor = db.session.connection().connection.cursor()
+        try:
+            if truncate:
+                cursor.execute("TRUNCATE promotion RESTART IDENTITY")
+            while copied < count:
+                buffer = io.StringIO()
+                write_csv_rows(itertools.islice(rows, CHUNK_SIZE), csv.writer(buffer))
+                buffer.seek(0)
+                cursor.copy_expert(statement, buffer)
+                copied += min(CHUNK_SIZE, count - copied)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            cursor.close()
+        db.session.execute(text("ANALYZE promotion"))
+        db.session.commit()
+    return copied
+
+
+def main():
+    """Generates the dataset and writes or loads it"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, required=True)
+    parser.add_argument("--products", type=int, help="distinct products, rows / 10 by default")
+    parser.add_argument("--skew", type=float, default=0.8, help="Zipf exponent of product popularity")
+    parser.add_argument("--types", type=parse_types, default=parse_types("VALUE=60,PERCENTAGE=35,UNKNOWN=5"))
+    parser.add_argument("--ongoing", type=float, default=0.8, help="fraction of ongoing Promotions")
+    parser.add_argument("--open-ended", type=float, default=0.05, help="fraction without an end date")
+    parser.add_argument("--start", type=parse_date, default=parse_date("2022-01-01"))
+    parser.add_argument("--days", type=int, default=365, help="days over which Promotions start")
+    parser.add_argument("--names", type=int, default=2000, help="distinct Promotion names")
+    parser.add_argument("--seed", type=int, default=0)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--format", choices=("csv", "ndjson"))
+    target.add_argument("--load", action="store_true", help="COPY into the database at DATABASE_URI")
+    parser.add_argument("--output", default="-", help="file to write, - for stdout")
+    parser.add_argument("--truncate", action="store_true", help="empty the table before loading")
+    args = parser.parse_args()
+
+    generator = Generator(
+        products=args.products or max(1, args.rows // 10),
+        skew=args.skew,
+        types=args.types,
+        ongoing=args.ongoing,
+        open_ended=args.open_ended,
+        start=args.start,
+        days=args.days,
+        names=name_pool(args.names, args.seed),
+        seed=args.seed,
+    )
+    rows = generator.rows(args.rows)
+    start = time.perf_counter()
+    if args.load:
+        load(rows, args.rows, args.truncate)
+    else:
+        writer = write_csv if args.format == "csv" else write_ndjson
+        if args.output == "-":
+            writer(rows, sys.stdout)
+        else:
+            with open(args.output, "w", encoding="utf-8", newline="") as output:
+                writer(rows, output)
+    elapsed = time.perf_counter() - start
+    print("{} {} rows in {:.1f} s ({:.0f} rows/s)".format(
+        "loaded" if args.load else "wrote", args.rows, elapsed, args.rows / elapsed
+    ), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+HTTP Load Benchmark
+
+Seeds --rows Promotions, then drives a weighted mix of API operations from
+--clients concurrent clients and reports the requests per second and the
+p50, p95 and p99 latency of the whole run and of each operation.
+
+The app runs under gunicorn as in the Procfile (with one sync worker with
+--server flask-sync, or under uvicorn with --server asgi) against the
+database at DATABASE_URI, which is emptied first; --url drives a server
+that is already running instead.
+
+The results are written as JSON with --output. Given a --baseline from an
+earlier run, the throughput and the latency of each operation are compared
+with it, and the command fails when one is worse by more than --tolerance.
+
+Usage:
+  python -m benchmarks.load [--rows 1000] [--requests 5000] [--clients 10]
+      [--mix list=25,filter=20,get=30,create=5,update=10,invalidate=5,delete=5]
+      [--output results.json] [--baseline old.json] [--tolerance 0.25]
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+from benchmarks.serving import (
+    GUNICORN_CONF, SERVERS, free_port, percentile, seed_promotions, start_server, stop_server,
+)
+from tests.factories import PromotionFactory
+
+SERVER_COMMANDS = {
+    "flask": GUNICORN_CONF,
+    "flask-sync": SERVERS["flask (gunicorn sync)"],
+    "asgi": SERVERS["asgi (uvicorn)"],
+}
+DEFAULT_MIX = "list=25,filter=20,get=30,create=5,update=10,invalidate=5,delete=5"
+FILTERS = (
+    {"product_id": None},
+    {"active_on": "01-21-2022 00:00:00 +0000"},
+    {"type": "VALUE"},
+    {"ongoing": "true"},
+    {"value_min": 20, "value_max": 40},
+)
+
+
+class Workload:
+    """
+    The Promotions a run knows about and the requests of each operation
+
+    Every operation returns the method, path, query parameters and JSON
+    body of its request, and a callback that updates the known Promotions
+    from the response.
+
+    The clients share one Workload; they run on one event loop, so no
+    locking is needed.
+    """
+
+    def __init__(self, promotions, seed=0):
+        self.promotions = promotions
+        self.ids = list(promotions)
+        self.random = random.Random(seed)
+
+    def _pick(self):
+        return self.random.choice(self.ids)
+
+    def list(self):
+        return "GET", "/promotions", {"limit": 20}, None, None
+
+    def filter(self):
+        params = dict(self.random.choice(FILTERS), limit=20)
+        if "product_id" in params:
+            params["product_id"] = self.promotions[self._pick()]["product_id"]
+        return "GET", "/promotions", params, None, None
+
+    def get(self):
+        return "GET", "/promotions/{}".format(self._pick()), None, None, None
+
+    def create(self):
+        body = PromotionFactory.build().serialize()
+        del body["id"]
+
+        def created(resp):
+            data = resp.json()
+            self.promotions[data["id"]] = data
+            self.ids.append(data["id"])
+
+        return "POST", "/promotions", None, body, created
+
+    def update(self):
+        promotion_id = self._pick()
+        body = dict(self.promotions[promotion_id], value=round(self.random.uniform(1, 99), 2))
+        return "PUT", "/promotions/{}".format(promotion_id), None, body, None
+
+    def invalidate(self):
+        return "PUT", "/promotions/{}/invalidate".format(self._pick()), None, None, None
+
+    def delete(self):
+        if len(self.ids) < 2:
+            return self.get()
+        # forget the Promotion first, so no other client asks for it
+        promotion_id = self.ids.pop(self.random.randrange(len(self.ids)))
+        del self.promotions[promotion_id]
+        return "DELETE", "/promotions/{}".format(promotion_id), None, None, None
+
+
+def parse_mix(text):
+    """Returns the operations and weights of a mix such as list=25,get=75"""
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if not hasattr(Workload, name) or name.startswith("_"):
+            raise argparse.ArgumentTypeError("unknown operation: {}".format(name))
+        try:
+            mix[name] = float(weight)
+        except ValueError as error:
+            raise argparse.ArgumentTypeError("bad weight of {}: {}".format(name, weight)) from error
+    return mix
+
+
+async def run_load(base_url, workload, mix, clients, requests):
+    """Sends `requests` requests of the `mix` from `clients` concurrent clients
+
+    Returns:
+        tuple: the elapsed seconds and, per operation, the latency and
+        status code of every request
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    samples = {name: [] for name in names}
+    remaining = [requests]
+
+    async def worker(client):
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            name = workload.random.choices(names, weights)[0]
+            method, path, params, body, callback = getattr(workload, name)()
+            start = time.perf_counter()
+            try:
+                resp = await client.request(method, path, params=params, json=body)
+            except (httpx.ReadError, httpx.RemoteProtocolError):
+                # a worker restarting after max_requests closes its idle
+                # kept-alive connections; retry like a browser would
+                resp = await client.request(method, path, params=params, json=body)
+            samples[name].append((time.perf_counter() - start, resp.status_code))
+            if callback is not None and resp.is_success:
+                callback(resp)
+
+    sessions = [httpx.AsyncClient(base_url=base_url, timeout=60.0) for _ in range(clients)]
+    try:
+        # open every connection before measuring
+        await asyncio.gather(*(client.get("/promotions?limit=1") for client in sessions))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for client in sessions))
+        return time.perf_counter() - start, samples
+    finally:
+        for client in sessions:
+            await client.aclose()
+
+
+def summarize(samples, elapsed):
+    """Returns the request rate, latency percentiles and status codes of `samples`"""
+    latencies = [latency for latency, _ in samples]
+    statuses = {}
+    for _, code in samples:
+        statuses[str(code)] = statuses.get(str(code), 0) + 1
+    if not latencies:
+        return {"requests": 0, "rps": 0.0, "statuses": statuses}
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "errors": sum(count for code, count in statuses.items() if code.startswith("5")),
+        "statuses": statuses,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints how `results` moved against `baseline` and returns the regressions
+
+    The throughput is compared for the whole run only, as the rate of each
+    operation follows from it and the mix; latencies are compared per
+    operation.
+    """
+    regressions = []
+    rps = results["overall"]["rps"] / baseline["overall"]["rps"] - 1
+    print("\nthroughput vs baseline: {:+.1%}".format(rps))
+    if rps < -tolerance:
+        regressions.append("throughput {:+.1%}".format(rps))
+    print("{:<12}{:>9}{:>9}".format("operation", "p50", "p99"))
+    for name, current in dict(results["operations"], overall=results["overall"]).items():
+        before = baseline["overall"] if name == "overall" else baseline["operations"].get(name)
+        if not before or not before.get("requests") or not current.get("requests"):
+            continue
+        print("{:<12}".format(name), end="")
+        for key in ("p50_ms", "p99_ms"):
+            change = current[key] / before[key] - 1
+            print("{:>+9.1%}".format(change), end="")
+            if change > tolerance:
+                regressions.append("{} {} {:+.1%}".format(name, key[:3], change))
+        print()
+    return regressions
+
+
+def main():
+    """Runs the benchmark, prints a table of the results and saves them"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--server", choices=sorted(SERVER_COMMANDS), default="flask")
+    parser.add_argument("--url", help="drive a running server instead of starting one")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with the JSON results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    process = None
+    base_url = args.url
+    if base_url is None:
+        port = free_port()
+        process = start_server(SERVER_COMMANDS[args.server], port)
+        base_url = "http://127.0.0.1:{}".format(port)
+    try:
+        bodies = [p.serialize() for p in PromotionFactory.build_batch(args.rows)]
+        ids = seed_promotions(base_url.rstrip("/"), bodies)
+        promotions = {}
+        for promotion_id, body in zip(ids, bodies):
+            promotions[promotion_id] = dict(body, id=promotion_id)
+        workload = Workload(promotions, args.seed)
+        elapsed, samples = asyncio.run(
+            run_load(base_url, workload, args.mix, args.clients, args.requests)
+        )
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    results = {
+        "started": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "server": args.server if args.url is None else args.url,
+            "rows": args.rows,
+            "requests": args.requests,
+            "clients": args.clients,
+            "mix": args.mix,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "elapsed_seconds": elapsed,
+        "overall": summarize([sample for values in samples.values() for sample in values], elapsed),
+        "operations": {name: summarize(values, elapsed) for name, values in samples.items()},
+    }
+
+    print("{:<12}{:>9}{:>9}{:>9}{:>9}{:>9}{:>8}".format(
+        "operation", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors"
+    ))
+    for name, summary in dict(results["operations"], overall=results["overall"]).items():
+        if not summary["requests"]:
+            continue
+        print("{:<12}{:>9}{:>9.0f}{:>9.1f}{:>9.1f}{:>9.1f}{:>8}".format(
+            name, summary["requests"], summary["rps"], summary["p50_ms"],
+            summary["p95_ms"], summary["p99_ms"], summary["errors"],
+        ))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        if regressions:
+            print("regressions beyond {:.0%}: {}".format(args.tolerance, "; ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Request Metrics Overhead Benchmark
+
+Times requests through the Flask test client with the request metrics of
+service.metrics recorded and with their hooks removed, on a route that
+does not touch the database and on GET /promotions/{id}. The difference
+is the cost the metrics add to every request; as it is close to the noise
+of a whole request, the hooks are also timed on their own.
+
+With --multiprocess the metrics are kept in files under a temporary
+PROMETHEUS_MULTIPROC_DIR, as they are under gunicorn.
+
+Usage:
+  python -m benchmarks.metrics [--requests 2000] [--repeat 5] [--multiprocess]
+"""
+import argparse
+import os
+import tempfile
+import timeit
+
+import flask
+
+
+def hooks(app, metrics):
+    """Returns the request hooks of the metrics registered on `app`"""
+    return (
+        (app.before_request_funcs[None], metrics.start_request),
+        (app.after_request_funcs[None], metrics.finish_request),
+        (app.teardown_request_funcs[None], metrics.end_request),
+    )
+
+
+def measure_hooks(app, metrics, path, calls, repeat):
+    """Returns the best time per request of the metric hooks alone"""
+    with app.test_request_context(path):
+        request = flask.request._get_current_object()
+        request.url_rule = app.url_map.bind("localhost").match(path, return_rule=True)[0]
+        response = flask.Response("{}")
+
+        def timed():
+            for _ in range(calls):
+                metrics.start_request()
+                metrics.finish_request(response)
+                metrics.end_request()
+
+        return min(timeit.repeat(timed, number=1, repeat=repeat)) / calls
+
+
+def measure(client, path, requests, repeat):
+    """Returns the best time per request of GET `path`"""
+    def timed():
+        for _ in range(requests):
+            client.get(path)
+
+    return min(timeit.repeat(timed, number=1, repeat=repeat)) / requests
+
+
+def main():
+    """Runs the benchmark and prints the time per request with and without metrics"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--multiprocess", action="store_true")
+    args = parser.parse_args()
+
+    if args.multiprocess:
+        # the metrics pick their storage when service.metrics is imported
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp()
+    from service import app, metrics
+    from service.models import Promotion
+    from tests.factories import PromotionFactory
+
+    with app.app_context():
+        Promotion.create_schema()
+        promotion = PromotionFactory()
+        promotion.create()
+        promotion_id = promotion.id
+    client = app.test_client()
+
+    print("{:<28}{:>12}{:>12}{:>12}".format("route", "off us", "on us", "overhead"))
+    for path in ("/stats/cache", "/promotions/{}".format(promotion_id)):
+        for funcs, hook in hooks(app, metrics):
+            funcs.remove(hook)
+        measure(client, path, 100, 1)
+        off = measure(client, path, args.requests, args.repeat)
+        for funcs, hook in hooks(app, metrics):
+            funcs.append(hook)
+        measure(client, path, 100, 1)
+        on = measure(client, path, args.requests, args.repeat)
+        print("{:<28}{:>12.1f}{:>12.1f}{:>11.1f}%".format(
+            path, off * 1e6, on * 1e6, (on - off) / off * 100
+        ))
+    hooks_only = measure_hooks(app, metrics, "/stats/cache", args.requests * 10, args.repeat)
+    print("metric hooks alone: {:.1f} us/request".format(hooks_only * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Model Layer Microbenchmark
+
+Times the hot paths of service.models: Promotion.serialize and
+Promotion.deserialize, parse_datetime_optional_timezone on repeated and on
+unique strings, and every finder on tables of each of the --rows sizes.
+Finders are timed on the first page of their results, as the list route
+reads them.
+
+Every case is warmed up, then timed over --rounds rounds; the median,
+mean, standard deviation and minimum time per call are reported together
+with the peak memory tracemalloc sees allocated during one call.
+
+The Promotion table of the database at DATABASE_URI is emptied and seeded
+with Promotions from tests.factories for every size. --save stores the
+results as a baseline; with --baseline the command fails when the minimum
+time or the peak memory of a case is worse than the baseline by more than
+--margin.
+
+Usage:
+  python -m benchmarks.models [--rows 1000 100000 1000000] [--rounds 7]
+      [--save baseline.json] [--baseline baseline.json] [--margin 0.25]
+"""
+import argparse
+import gc
+import itertools
+import json
+import logging
+import random
+import statistics
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime, timezone
+
+import factory
+from sqlalchemy import text
+
+from benchmarks.parse_datetime import make_strings
+from service import app
+from service.models import Promotion, Type, db, parse_datetime_optional_timezone
+from tests.factories import PromotionFactory
+
+# Promotions per page, as GET /promotions?limit= would ask for
+PAGE_SIZE = 20
+# Promotions created per INSERT transaction while seeding
+SEED_BATCH = 10000
+# the date most Promotions of the factory are active on
+ACTIVE_DATE = datetime(2022, 1, 25, tzinfo=timezone.utc)
+
+
+class Case:
+    """
+    A timed call
+
+    One run of `func` makes `items` calls, so that calls too quick to
+    time alone are timed in a loop; `once` makes a single call for the
+    memory measurement.
+    """
+
+    def __init__(self, name, func, items=1, once=None):
+        self.name = name
+        self.func = func
+        self.items = items
+        self.once = once or func
+
+
+def in_memory_cases(count):
+    """Returns the cases that do not touch the database"""
+    promotions = PromotionFactory.build_batch(count)
+    data = [promotion.serialize() for promotion in promotions]
+    generator = random.Random(1)
+    distinct = make_strings(50)
+    repeated = [generator.choice(distinct) for _ in range(count)]
+    unique = make_strings(count, seed=2)
+    uncached = parse_datetime_optional_timezone.__wrapped__
+
+    def serialize():
+        for promotion in promotions:
+            promotion.serialize()
+
+    def deserialize():
+        for item in data:
+            Promotion().deserialize(item)
+
+    def parse_repeated():
+        for time_str in repeated:
+            parse_datetime_optional_timezone(time_str)
+
+    def parse_unique():
+        for time_str in unique:
+            uncached(time_str)
+
+    return [
+        Case("serialize", serialize, count, promotions[0].serialize),
+        Case("deserialize", deserialize, count, lambda: Promotion().deserialize(data[0])),
+        Case(
+            "parse_datetime repeated", parse_repeated, count,
+            lambda: parse_datetime_optional_timezone(repeated[0]),
+        ),
+        Case("parse_datetime unique", parse_unique, count, lambda: uncached(unique[0])),
+    ]
+
+
+def seed(rows):
+    """Replaces every Promotion with `rows` new ones
+
+    A fifth as many products as Promotions are used, so that product
+    lookups find a few Promotions each.
+    """
+    Promotion.query.delete()
+    db.session.commit()
+    generator = random.Random(0)
+    products = max(1, rows // 5)
+    for start in range(0, rows, SEED_BATCH):
+        promotions = PromotionFactory.build_batch(min(SEED_BATCH, rows - start))
+        for promotion in promotions:
+            promotion.product_id = generator.randrange(products)
+        Promotion.bulk_create(promotions)
+    db.session.execute(text("ANALYZE promotion"))
+    db.session.commit()
+
+
+def finder_cases(rows):
+    """Returns a case for every finder on a table of `rows` Promotions"""
+    all_ids = [row.id for row in db.session.query(Promotion.id).order_by(Promotion.id)]
+    sample = Promotion.find_by_ids(random.Random(0).sample(all_ids, min(100, len(all_ids)))).all()
+    columns = {
+        "ids": [promotion.id for promotion in sample],
+        "names": [promotion.name for promotion in sample],
+        "products": [promotion.product_id for promotion in sample],
+        "start_dates": [promotion.start_date for promotion in sample],
+    }
+    db.session.expunge_all()
+
+    def page(query):
+        Promotion.paginate(query, limit=PAGE_SIZE).all()
+        db.session.expunge_all()
+
+    def find(promotion_id):
+        Promotion.find(promotion_id)
+        db.session.expunge_all()
+
+    def finders():
+        """Returns the finders, each looking up the next of the sampled values"""
+        ids, names, products, start_dates = (itertools.cycle(values) for values in columns.values())
+
+        def several(values, count=10):
+            return [next(values) for _ in range(count)]
+
+        return {
+            "find": lambda: find(next(ids)),
+            "find_by_name": lambda: page(Promotion.find_by_name(next(names))),
+            "find_by_product_id": lambda: page(Promotion.find_by_product_id(next(products))),
+            "find_by_product_ids": lambda: page(Promotion.find_by_product_ids(several(products))),
+            "find_by_ids": lambda: page(Promotion.find_by_ids(several(ids))),
+            "find_by_start_date": lambda: page(Promotion.find_by_start_date(next(start_dates))),
+            "find_active": lambda: page(Promotion.find_active(ACTIVE_DATE)),
+            "find_applicable": lambda: page(Promotion.find_applicable(ACTIVE_DATE, several(products, 5))),
+            "find_matching": lambda: page(Promotion.find_matching(
+                active_on=ACTIVE_DATE, promotion_type=Type.VALUE, ongoing=True
+            )),
+        }
+
+    def first(name):
+        # memory is measured on the same values on every run
+        return lambda: finders()[name]()
+
+    return [
+        Case("{} @{}".format(name, rows), func, once=first(name))
+        for name, func in finders().items()
+    ]
+
+
+def measure(case, rounds):
+    """Returns the timing and memory statistics of a case, per call"""
+    timer = timeit.Timer(case.func)
+    # autorange warms up caches and connections while it finds how many
+    # runs take 0.2 seconds; each round makes half as many
+    number = max(1, int(timer.autorange()[0] / 2))
+    times = [seconds / number / case.items for seconds in timer.repeat(rounds, number)]
+
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    case.once()
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return {
+        "median_us": statistics.median(times) * 1e6,
+        "mean_us": statistics.mean(times) * 1e6,
+        "stdev_us": statistics.stdev(times) * 1e6 if len(times) > 1 else 0.0,
+        "min_us": min(times) * 1e6,
+        "peak_kib": peak / 1024,
+    }
+
+
+def compare(results, baseline, margin):
+    """Returns the cases of `results` that are worse than `baseline` by more than `margin`"""
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        # other processes only ever slow a round down, so the fastest
+        # round is the most repeatable measure of the code itself
+        if current["min_us"] > before["min_us"] * (1 + margin):
+            regressions.append("{} time {:.1f} us vs {:.1f} us".format(
+                name, current["min_us"], before["min_us"]
+            ))
+        # a KiB of slack keeps cases that hardly allocate from flapping
+        if current["peak_kib"] > before["peak_kib"] * (1 + margin) + 1:
+            regressions.append("{} memory {:.1f} KiB vs {:.1f} KiB".format(
+                name, current["peak_kib"], before["peak_kib"]
+            ))
+    return regressions
+
+
+def main():
+    """Runs the benchmark, prints a table of the results and checks the baseline"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 100000])
+    parser.add_argument("--items", type=int, default=1000, help="objects per in-memory run")
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--save", help="write the results as a JSON baseline to this file")
+    parser.add_argument("--baseline", help="compare with a baseline written by --save")
+    parser.add_argument("--margin", type=float, default=0.25)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    # the same data on every run, so runs compare with the baseline
+    factory.random.reseed_random(0)
+    print("{:<34}{:>11}{:>11}{:>11}{:>11}{:>11}".format(
+        "case", "median us", "mean us", "stdev us", "min us", "peak KiB"
+    ))
+    results = {}
+
+    def report(cases):
+        for case in cases:
+            stats = results[case.name] = measure(case, args.rounds)
+            print("{:<34}{:>11.2f}{:>11.2f}{:>11.2f}{:>11.2f}{:>11.2f}".format(
+                case.name, stats["median_us"], stats["mean_us"], stats["stdev_us"],
+                stats["min_us"], stats["peak_kib"],
+            ))
+            sys.stdout.flush()
+
+    with app.app_context():
+        Promotion.create_schema()
+        report(in_memory_cases(args.items))
+        for rows in args.rows:
+            seed(rows)
+            report(finder_cases(rows))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline:
+            regressions = compare(results, json.load(baseline), args.margin)
+        if regressions:
+            print("regressions beyond {:.0%}:\n  {}".format(args.margin, "\n  ".join(regressions)))
+            sys.exit(1)
+        print("no regressions beyond {:.0%}".format(args.margin))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Datetime Parsing Microbenchmark
+
+Compares the original two-strptime parse_datetime_optional_timezone with
+the single-pass, memoized parser in service.models, on a workload where a
+few distinct strings repeat like the active_on of popular queries, and on
+one where every string is new.
+
+Usage:
+  python -m benchmarks.parse_datetime [--calls 100000] [--distinct 50] [--repeat 5]
+"""
+import argparse
+import random
+import timeit
+from datetime import datetime, timedelta, timezone
+
+from service.models import parse_datetime_optional_timezone
+
+
+def legacy_parse(time_str):
+    """The original parser: strptime with %z, then again without it"""
+    time_str = time_str.strip()
+    try:
+        return datetime.strptime(time_str, "%m-%d-%Y %H:%M:%S %z")
+    except:
+        date = datetime.strptime(time_str, "%m-%d-%Y %H:%M:%S")
+        date.replace(tzinfo=timezone.utc)
+        return date
+
+
+def make_strings(count, seed=0):
+    """Returns `count` date strings, half of them without a UTC offset"""
+    generator = random.Random(seed)
+    start = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    strings = []
+    for index in range(count):
+        date = start + timedelta(seconds=generator.randrange(365 * 24 * 3600))
+        fmt = "%m-%d-%Y %H:%M:%S %z" if index % 2 else "%m-%d-%Y %H:%M:%S"
+        strings.append(date.strftime(fmt))
+    return strings
+
+
+def run(parse, strings):
+    """Parses every string"""
+    for time_str in strings:
+        parse(time_str)
+
+
+def measure(label, parse, strings, repeat, reset=None):
+    """Prints the best time per call of `parse` over `strings`"""
+    def timed():
+        if reset is not None:
+            reset()
+        run(parse, strings)
+
+    best = min(timeit.repeat(timed, number=1, repeat=repeat))
+    print("{:<28}{:8.2f} us/call".format(label, best / len(strings) * 1e6))
+    return best
+
+
+def main():
+    """Runs the benchmark and prints the time per call of each parser"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=100000)
+    parser.add_argument("--distinct", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    generator = random.Random(1)
+    distinct = make_strings(args.distinct)
+    repeated = [generator.choice(distinct) for _ in range(args.calls)]
+    unique = make_strings(args.calls, seed=2)
+    uncached = parse_datetime_optional_timezone.__wrapped__
+    for time_str in distinct:
+        expected = legacy_parse(time_str)
+        if expected.tzinfo is None:
+            expected = expected.replace(tzinfo=timezone.utc)
+        assert parse_datetime_optional_timezone(time_str) == expected
+
+    print("calls: {}, distinct strings: {}".format(args.calls, args.distinct))
+    print("repeated strings")
+    before = measure("  original", legacy_parse, repeated, args.repeat)
+    after = measure(
+        "  single pass + cache",
+        parse_datetime_optional_timezone,
+        repeated,
+        args.repeat,
+        parse_datetime_optional_timezone.cache_clear,
+    )
+    print("  speedup: {:.1f}x".format(before / after))
+    print("unique strings")
+    before = measure("  original", legacy_parse, unique, args.repeat)
+    after = measure("  single pass, no cache", uncached, unique, args.repeat)
+    print("  speedup: {:.1f}x".format(before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Serialization Microbenchmark
+
+Compares the per-row cost of the original list serialization path
+(Promotion.serialize, Flask-RESTX marshalling and json.dumps) with the
+precompiled row encoder in service.serializers.
+
+Usage:
+  python -m benchmarks.serialize [--rows 10000] [--repeat 5]
+"""
+import argparse
+import json
+import timeit
+
+from service.models import Promotion
+from service.routes import api, promotion_model
+from service.serializers import encode_list, encode_row
+from tests.factories import PromotionFactory
+
+
+def marshalled(promotions):
+    """The original path: serialize, marshal, then encode"""
+    results = [promotion.serialize() for promotion in promotions]
+    return json.dumps(api.marshal(results, promotion_model))
+
+
+def encoded(rows):
+    """The fast path: encode rows straight to JSON text"""
+    return encode_list([encode_row(row) for row in rows])
+
+
+def main():
+    """Runs the benchmark and prints the time per row of both paths"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    promotions = PromotionFactory.build_batch(args.rows)
+    rows = [
+        tuple(getattr(promotion, field) for field in Promotion.ROW_FIELDS)
+        for promotion in promotions
+    ]
+    assert json.loads(marshalled(promotions[:100])) == json.loads(encoded(rows[:100]))
+
+    before = min(timeit.repeat(lambda: marshalled(promotions), number=1, repeat=args.repeat))
+    after = min(timeit.repeat(lambda: encoded(rows), number=1, repeat=args.repeat))
+    print("rows:              {}".format(args.rows))
+    print("marshal path:      {:8.2f} us/row".format(before / args.rows * 1e6))
+    print("precompiled path:  {:8.2f} us/row".format(after / args.rows * 1e6))
+    print("speedup:           {:8.1f}x".format(before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Serving Mode Benchmark
+
+Starts the Flask app under gunicorn with one sync worker, one request at
+a time, and the ASGI app under uvicorn with one worker, then measures
+the requests per second and latency percentiles of each at 1, 10 and 100
+concurrent clients.
+
+The database at DATABASE_URI is emptied and seeded with --rows Promotions
+first. Every client alternates between a page of the list and a single
+Promotion.
+
+Usage:
+  python -m benchmarks.serving [--requests 2000] [--rows 1000] [--clients 1 10 100]
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from tests.factories import PromotionFactory
+
+# gunicorn with the worker model of gunicorn.conf.py, as the Procfile runs it
+GUNICORN_CONF = ["gunicorn", "--bind=127.0.0.1:{port}", "--log-level=warning", "service:app"]
+
+SERVERS = {
+    "flask (gunicorn sync)": [
+        "gunicorn", "--workers=1", "--worker-class=sync", "--bind=127.0.0.1:{port}",
+        "--log-level=warning", "service:app",
+    ],
+    "asgi (uvicorn)": [
+        "uvicorn", "--workers=1", "--host=127.0.0.1", "--port={port}", "--log-level=warning",
+        "service.asgi:app",
+    ],
+}
+
+
+def free_port():
+    """Returns a TCP port nobody is listening on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(command, port, timeout=30.0, env=None):
+    """Creates the tables, starts a server with extra `env` variables and waits until it answers"""
+    env = dict(os.environ, PYTHONPATH=os.getcwd(), **(env or {}))
+    subprocess.run(
+        [sys.executable, "-m", "flask", "init-db"],
+        stdout=subprocess.DEVNULL,
+        env=dict(env, FLASK_APP="service:app"),
+        check=True,
+    )
+    process = subprocess.Popen(
+        [part.format(port=port) for part in command],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env=env,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("{} exited with {}".format(command[0], process.returncode))
+        try:
+            httpx.get("http://127.0.0.1:{}/promotions/count".format(port), timeout=1.0)
+            return process
+        except httpx.TransportError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("{} did not start in {} seconds".format(command[0], timeout))
+
+
+def stop_server(process):
+    """Stops a server started by start_server"""
+    process.terminate()
+    process.wait(timeout=10)
+
+
+def seed(base_url, rows):
+    """Replaces every Promotion with `rows` new ones and returns their ids"""
+    promotions = [promotion.serialize() for promotion in PromotionFactory.build_batch(rows)]
+    return seed_promotions(base_url, promotions)
+
+
+def seed_promotions(base_url, promotions):
+    """Replaces every Promotion with the serialized `promotions` and returns their ids"""
+    httpx.delete(base_url + "/promotions", params={"all": "true"}).raise_for_status()
+    ids = []
+    # in batches, so large datasets stay within a reasonable request size
+    for start in range(0, len(promotions), 5000):
+        batch = promotions[start:start + 5000]
+        resp = httpx.post(base_url + "/promotions/bulk", json=batch, timeout=120.0)
+        resp.raise_for_status()
+        ids.extend(resp.json()["ids"])
+    return ids
+
+
+async def run_load(base_url, ids, clients, requests):
+    """Sends `requests` requests from `clients` concurrent clients
+
+    Every client has a connection of its own, like separate callers would;
+    a shared httpx connection pool queues requests unfairly and dominates
+    the tail latency at 100 clients.
+
+    Returns:
+        tuple: the elapsed seconds and the latency of every request
+    """
+    paths = ["/promotions?limit=20"] + ["/promotions/{}".format(i) for i in ids[:100]]
+    latencies = []
+    remaining = [requests]
+
+    async def worker(client, number):
+        generator = random.Random(number)
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            path = paths[0] if remaining[0] % 2 else generator.choice(paths[1:])
+            start = time.perf_counter()
+            try:
+                resp = await client.get(path)
+            except (httpx.ReadError, httpx.RemoteProtocolError):
+                # a worker restarting after max_requests closes its idle
+                # kept-alive connections; retry like a browser would
+                resp = await client.get(path)
+            latencies.append(time.perf_counter() - start)
+            resp.raise_for_status()
+
+    sessions = [httpx.AsyncClient(base_url=base_url, timeout=60.0) for _ in range(clients)]
+    try:
+        # open every connection before measuring
+        await asyncio.gather(*(client.get(paths[0]) for client in sessions))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client, number) for number, client in enumerate(sessions)))
+        return time.perf_counter() - start, latencies
+    finally:
+        for client in sessions:
+            await client.aclose()
+
+
+def percentile(values, fraction):
+    """Returns the value below which `fraction` of `values` fall"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    """Runs the benchmark and prints a table of the results"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100])
+    args = parser.parse_args()
+
+    print("{:<24}{:>8}{:>10}{:>10}{:>10}".format("server", "clients", "req/s", "p50 ms", "p99 ms"))
+    ids = None
+    for name, command in SERVERS.items():
+        port = free_port()
+        process = start_server(command, port)
+        base_url = "http://127.0.0.1:{}".format(port)
+        try:
+            if ids is None:
+                ids = seed(base_url, args.rows)
+            for clients in args.clients:
+                elapsed, latencies = asyncio.run(run_load(base_url, ids, clients, args.requests))
+                print("{:<24}{:>8}{:>10.0f}{:>10.1f}{:>10.1f}".format(
+                    name,
+                    clients,
+                    len(latencies) / elapsed,
+                    percentile(latencies, 0.50) * 1000,
+                    percentile(latencies, 0.99) * 1000,
+                ))
+                sys.stdout.flush()
+        finally:
+            stop_server(process)
+
+
+if __name__ == "__main__":
+    main()
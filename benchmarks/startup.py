@@ -0,0 +1,168 @@
+"""
+Cold Start Benchmark
+
+Measures how long a new instance of the service takes to start:
+
+- the import of the service package in a fresh interpreter, as
+  `python -X importtime` reports it, with the packages that take longest
+- the wall time of that interpreter, and of one that imports nothing
+- the time from starting gunicorn with one worker until it answers GET /,
+  and until it answers GET /promotions/count, the first query
+
+Each is the median of --runs runs. The results are written as JSON with
+--output; given a --baseline from an earlier run, the command fails when
+the import or the first response is slower by more than --tolerance.
+
+Usage:
+  python -m benchmarks.startup [--runs 10] [--top 10]
+      [--output startup.json] [--baseline startup.json] [--tolerance 0.25]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.serving import GUNICORN_CONF, free_port, stop_server
+
+# `python -X importtime` writes "self us | cumulative us | module" lines,
+# the module indented by how deeply it is nested
+IMPORTTIME_PREFIX = "import time:"
+
+
+def parse_importtime(output):
+    """Returns the cumulative ms of `service` and the self ms of each top-level package"""
+    total = None
+    packages = {}
+    for line in output.splitlines():
+        if not line.startswith(IMPORTTIME_PREFIX) or "cumulative" in line:
+            continue
+        own, cumulative, name = line[len(IMPORTTIME_PREFIX):].split("|")
+        name = name.strip()
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0.0) + int(own) / 1000
+        if name == "service":
+            total = int(cumulative) / 1000
+    return total, packages
+
+
+def time_import(env):
+    """Returns the wall ms, the import ms and the packages of one import of the service"""
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import service"],
+        env=env, capture_output=True, text=True, check=True,
+    )
+    wall = (time.perf_counter() - start) * 1000
+    total, packages = parse_importtime(process.stderr)
+    return wall, total, packages
+
+
+def time_interpreter(env):
+    """Returns the wall ms of an interpreter that imports nothing"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], env=env, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def time_first_responses(env, timeout=30.0):
+    """Returns the ms from starting gunicorn until GET / and the first query answer"""
+    port = free_port()
+    base_url = "http://127.0.0.1:{}".format(port)
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [part.format(port=port) for part in GUNICORN_CONF],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env=dict(env, WEB_CONCURRENCY="1"),
+    )
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError("gunicorn exited with {}".format(process.returncode))
+            if time.monotonic() > deadline:
+                raise RuntimeError("gunicorn did not start in {} seconds".format(timeout))
+            try:
+                httpx.get(base_url + "/", timeout=1.0).raise_for_status()
+                break
+            except httpx.TransportError:
+                time.sleep(0.01)
+        ready = (time.perf_counter() - start) * 1000
+        httpx.get(base_url + "/promotions/count", timeout=timeout).raise_for_status()
+        first_query = (time.perf_counter() - start) * 1000
+    finally:
+        stop_server(process)
+    return ready, first_query
+
+
+def compare(results, baseline, tolerance):
+    """Prints how `results` moved against `baseline` and returns the regressions"""
+    regressions = []
+    print("\nvs baseline:")
+    for key in ("import_ms", "ready_ms", "first_query_ms"):
+        change = results[key] / baseline[key] - 1
+        print("  {:<16}{:>+9.1%}".format(key, change))
+        if change > tolerance:
+            regressions.append("{} {:+.1%}".format(key, change))
+    return regressions
+
+
+def main():
+    """Runs the benchmark, prints the results and checks the baseline"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="packages to list by import time")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with the JSON results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    interpreter, walls, imports, responses = [], [], [], []
+    packages = {}
+    for _ in range(args.runs):
+        interpreter.append(time_interpreter(env))
+        wall, total, run_packages = time_import(env)
+        walls.append(wall)
+        imports.append(total)
+        for package, own in run_packages.items():
+            packages.setdefault(package, []).append(own)
+        responses.append(time_first_responses(env))
+
+    results = {
+        "interpreter_ms": statistics.median(interpreter),
+        "import_wall_ms": statistics.median(walls),
+        "import_ms": statistics.median(imports),
+        "ready_ms": statistics.median(ready for ready, _ in responses),
+        "first_query_ms": statistics.median(first for _, first in responses),
+        "packages_ms": {package: statistics.median(times) for package, times in packages.items()},
+    }
+    print("interpreter alone       {:>9.1f} ms".format(results["interpreter_ms"]))
+    print("import service (wall)   {:>9.1f} ms".format(results["import_wall_ms"]))
+    print("import service          {:>9.1f} ms".format(results["import_ms"]))
+    print("gunicorn answers GET /  {:>9.1f} ms".format(results["ready_ms"]))
+    print("first query answered    {:>9.1f} ms".format(results["first_query_ms"]))
+    print("\n{:<24}{:>9}".format("package", "self ms"))
+    ranked = sorted(results["packages_ms"].items(), key=lambda item: item[1], reverse=True)
+    for package, own in ranked[:args.top]:
+        print("{:<24}{:>9.1f}".format(package, own))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        if regressions:
+            print("regressions beyond {:.0%}: {}".format(args.tolerance, ", ".join(regressions)))
+            sys.exit(1)
+        print("no regressions beyond {:.0%}".format(args.tolerance))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+gunicorn Worker Model Benchmark
+
+Runs the Flask app under gunicorn with several worker models set through
+the environment variables gunicorn.conf.py reads, and measures for each
+the requests per second and latency percentiles of one instance at
+--clients concurrent clients, together with the memory of the instance:
+the proportional set size (PSS) of the master and its workers, which
+counts pages the workers share copy-on-write only once.
+
+The database at DATABASE_URI is emptied and seeded with --rows Promotions
+first. Every client alternates between a page of the list and a single
+Promotion, as in benchmarks.serving.
+
+Usage:
+  python -m benchmarks.workers [--requests 2000] [--rows 1000] [--clients 10 50]
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+from benchmarks.serving import (
+    GUNICORN_CONF, free_port, percentile, run_load, seed, start_server, stop_server,
+)
+
+# the previous Procfile and the worker models of gunicorn.conf.py
+CONFIGS = {
+    "sync x1": {"GUNICORN_WORKER_CLASS": "sync", "WEB_CONCURRENCY": "1", "GUNICORN_PRELOAD": "false"},
+    "sync x3": {"GUNICORN_WORKER_CLASS": "sync", "WEB_CONCURRENCY": "3"},
+    "gthread x1 t4": {"WEB_CONCURRENCY": "1", "GUNICORN_THREADS": "4"},
+    "gthread x3 t4": {"WEB_CONCURRENCY": "3", "GUNICORN_THREADS": "4"},
+    "gthread x3 t4 no preload": {"WEB_CONCURRENCY": "3", "GUNICORN_THREADS": "4", "GUNICORN_PRELOAD": "false"},
+    "gevent x3": {"GUNICORN_WORKER_CLASS": "gevent", "WEB_CONCURRENCY": "3"},
+}
+
+
+def instance_memory(pid):
+    """Returns the PSS of a process and its children in MiB, summed from /proc"""
+    pids = [pid]
+    with open("/proc/{}/task/{}/children".format(pid, pid), encoding="ascii") as children:
+        pids.extend(int(child) for child in children.read().split())
+    total = 0
+    for process in pids:
+        with open("/proc/{}/smaps_rollup".format(process), encoding="ascii") as rollup:
+            for line in rollup:
+                if line.startswith("Pss:"):
+                    total += int(line.split()[1])
+    return total / 1024
+
+
+def available(config):
+    """Tells whether the worker class of `config` can be imported"""
+    if config.get("GUNICORN_WORKER_CLASS") != "gevent":
+        return True
+    try:
+        import gevent  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        return False
+    return True
+
+
+def main():
+    """Runs the benchmark and prints a table of the results"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--configs", nargs="+", choices=sorted(CONFIGS), default=list(CONFIGS))
+    args = parser.parse_args()
+
+    print("{:<26}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+        "workers", "clients", "req/s", "p50 ms", "p99 ms", "PSS MiB"
+    ))
+    ids = None
+    for name in args.configs:
+        config = CONFIGS[name]
+        if not available(config):
+            print("{:<26}  skipped: gevent is not installed".format(name))
+            continue
+        port = free_port()
+        process = start_server(GUNICORN_CONF, port, env=config)
+        base_url = "http://127.0.0.1:{}".format(port)
+        try:
+            if ids is None:
+                ids = seed(base_url, args.rows)
+            for clients in args.clients:
+                elapsed, latencies = asyncio.run(run_load(base_url, ids, clients, args.requests))
+                print("{:<26}{:>8}{:>10.0f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+                    name,
+                    clients,
+                    len(latencies) / elapsed,
+                    percentile(latencies, 0.50) * 1000,
+                    percentile(latencies, 0.99) * 1000,
+                    instance_memory(process.pid),
+                ))
+                sys.stdout.flush()
+        finally:
+            stop_server(process)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,7 +22,63 @@ if 'VCAP_SERVICES' in os.environ:
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-SQLALCHEMY_POOL_SIZE = 2
+# Connection pool of each process: DB_POOL_SIZE connections are kept open
+# and up to DB_MAX_OVERFLOW more are opened under bursts; a request waits
+# at most DB_POOL_TIMEOUT seconds for one. Connections older than
+# DB_POOL_RECYCLE seconds are replaced (-1 never), and DB_POOL_PRE_PING
+# tests each connection before handing it out.
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "2")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "-1")),
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "false").lower() == "true",
+}
+
+# Comma separated URIs of read replicas of DATABASE_URI: GET and HEAD
+# requests read from them in turn, skipping replicas that fail the health
+# check a background thread runs every REPLICA_CHECK_SECONDS; a client
+# reads from the primary, bypassing the result cache, for
+# REPLICA_STICKY_SECONDS after each of its writes
+DATABASE_REPLICA_URIS = [uri.strip() for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri.strip()]
+REPLICA_CHECK_SECONDS = float(os.getenv("REPLICA_CHECK_SECONDS", "5"))
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", "10"))
+
+# Connections in the asyncpg pool of the ASGI entry point, service.asgi
+ASYNC_POOL_SIZE = int(os.getenv("ASYNC_POOL_SIZE", "10"))
+
+# Largest page a client may request from GET /promotions?limit=
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Most Promotions one POST /promotions/bulk request may create
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "5000"))
+
+# Most ids one request may look up through ?id=, ?product_id= or /promotions/lookup
+LOOKUP_MAX_KEYS = int(os.getenv("LOOKUP_MAX_KEYS", "1000"))
+
+# Answer ?active_on= lookups from an in-process interval index instead of
+# the database; the index is reloaded once it is older than the max age
+ACTIVE_INDEX_ENABLED = os.getenv("ACTIVE_INDEX_ENABLED", "false").lower() == "true"
+ACTIVE_INDEX_MAX_AGE = float(os.getenv("ACTIVE_INDEX_MAX_AGE", "60"))
+
+# Cache up to RESULT_CACHE_SIZE GET results for RESULT_CACHE_TTL seconds;
+# writes evict the results they affect, 0 turns the cache off
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "0"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "30"))
+
+# Counts requested with ?estimate=true come from the planner statistics
+# instead of count(*) once the planner expects at least this many rows
+COUNT_ESTIMATE_MIN = int(os.getenv("COUNT_ESTIMATE_MIN", "100000"))
+
+# Record the latency, status and size of every request for GET /metrics;
+# gunicorn workers share them through PROMETHEUS_MULTIPROC_DIR
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Report the number and time of the SQL statements of each request in a
+# Server-Timing header, and log statements taking SLOW_QUERY_SECONDS or
+# more with their parameters and plan (0 never)
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "0.5"))
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
@@ -0,0 +1,140 @@
+"""
+gunicorn settings of the service
+
+gunicorn reads this file from the working directory on start. Settings
+given on the command line take precedence over the ones here.
+
+Workers: WEB_CONCURRENCY workers, by default 2 per CPU plus one, but no
+more than fit in the memory limit of the instance (MEMORY_LIMIT as Cloud
+Foundry sets it, or the cgroup limit) at WORKER_MEMORY_MB each.
+GUNICORN_WORKER_CLASS picks gthread (the default), sync or gevent;
+gthread workers run GUNICORN_THREADS threads and gevent workers up to
+GUNICORN_WORKER_CONNECTIONS requests at a time. gevent needs the gevent
+and psycogreen packages.
+
+The app is loaded once in the master (GUNICORN_PRELOAD) so the workers
+share its memory copy-on-write. gevent workers never preload: they
+monkey-patch the standard library when they start, and an app the master
+loaded before that keeps locks and a psycopg2 that block the whole worker. Workers restart after about
+GUNICORN_MAX_REQUESTS requests, with some jitter so they do not all
+restart at once.
+
+Every worker writes its request metrics to PROMETHEUS_MULTIPROC_DIR so
+that GET /metrics on any worker reports the whole server.
+"""
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+
+# memory of the master and of each worker in MiB; benchmarks.workers
+# measures about 60 for the master with the preloaded app and 18 for a
+# fresh worker, which grows as its caches fill up
+MASTER_MEMORY_MB = 60
+WORKER_MEMORY_MB = int(os.getenv("WORKER_MEMORY_MB", "40"))
+
+
+def parse_size(value):
+    """Returns the bytes of a size such as 256M, 1g or 268435456"""
+    match = re.fullmatch(r"\s*(\d+)\s*([kmgt]?)b?\s*", value, re.IGNORECASE)
+    if match is None:
+        raise ValueError("Invalid memory size: {}".format(value))
+    return int(match.group(1)) * 1024 ** " kmgt".index(match.group(2).lower() or " ")
+
+
+def memory_limit():
+    """Returns the bytes of memory the instance may use, None if unlimited"""
+    if os.getenv("MEMORY_LIMIT"):
+        return parse_size(os.environ["MEMORY_LIMIT"])
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path, encoding="ascii") as limit:
+                value = limit.read().strip()
+        except OSError:
+            continue
+        # unlimited cgroups report "max" or a huge number
+        if value == "max" or int(value) >= 1 << 60:
+            return None
+        return int(value)
+    return None
+
+
+def default_workers():
+    """Returns 2 workers per CPU plus one, as many as fit in memory"""
+    workers = 2 * multiprocessing.cpu_count() + 1
+    limit = memory_limit()
+    if limit is not None:
+        fit = (limit // 1024 ** 2 - MASTER_MEMORY_MB) // WORKER_MEMORY_MB
+        workers = max(1, min(workers, fit))
+    return workers
+
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY") or default_workers())
+# gunicorn turns sync workers into gthread ones when threads is above one
+threads = int(os.getenv("GUNICORN_THREADS", "4")) if worker_class == "gthread" else 1
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+# gevent workers must load the app after their monkey-patching
+preload_app = worker_class != "gevent" and os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", str(max_requests // 10)))
+
+# set before the app is loaded, which creates the metrics
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "promotions-metrics")
+)
+
+
+def on_starting(server):
+    """Drops the metrics a previous server left behind"""
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def when_ready(server):
+    """Closes any database connection the master opened loading the app
+
+    The master does not serve requests, and a connection it keeps open
+    would be inherited by every worker it forks.
+    """
+    if server.cfg.preload_app:
+        from service.models import db
+
+        db.engine.dispose()
+
+
+def post_fork(server, worker):
+    """Makes the worker open database connections of its own"""
+    if server.cfg.preload_app:
+        from service.models import db
+        from service.replicas import replicas
+
+        # forget inherited connections without closing them for the master
+        db.engine.dispose(close=False)
+        for replica in replicas.replicas:
+            replica.engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    """Makes psycopg2 yield to other greenlets in gevent workers
+
+    Runs once the worker has monkey-patched the standard library and
+    loaded the app, before it accepts a request.
+    """
+    if worker.cfg.worker_class_str != "gevent":
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        worker.log.warning("psycogreen is not installed: queries block the whole gevent worker")
+    else:
+        patch_psycopg()
+
+
+def child_exit(server, worker):
+    """Stops counting the in-flight requests of a worker that exited"""
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
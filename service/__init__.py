@@ -5,8 +5,13 @@ This module creates and configures the Flask app and sets up the logging
 and SQL database
 """
 import sys
+import time
 import logging
-from flask import Flask
+
+# the import of the service is timed from here
+_started = time.perf_counter()
+
+from flask import Flask  # noqa: E402 pylint: disable=wrong-import-position
 
 # Create Flask application
 app = Flask(__name__)
@@ -14,7 +19,15 @@ app.url_map.strict_slashes = False
 app.config.from_object("config")
 
 # Import the routes After the Flask app is created
-from service import routes, models
+from service import routes, models, metrics
+from service.queries import query_log
+from service.replicas import replicas
+
+if app.config["METRICS_ENABLED"]:
+    metrics.instrument(app)
+if app.config["SERVER_TIMING_ENABLED"]:
+    query_log.instrument(app)
+replicas.instrument(app, models.db.session)
 
 # Set up logging for production
 print("Setting up logging for {}...".format(__name__))
@@ -37,10 +50,11 @@ app.logger.info("  P R O M O T I O N   S E R V I C E   R U N N I N G  ".center(7
 app.logger.info(70 * "*")
 
 try:
-    routes.init_db()  # make our sqlalchemy tables
+    # connects lazily; `flask init-db` makes our sqlalchemy tables
+    routes.init_db()
 except Exception as error:
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
     sys.exit(4)
 
-app.logger.info("Service initialized!")
+app.logger.info("Service initialized in %.0f ms!", (time.perf_counter() - _started) * 1000)
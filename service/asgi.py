@@ -0,0 +1,282 @@
+"""
+ASGI entry point of the Promotions service
+
+Serves the Promotion resources with async handlers on an asyncpg
+connection pool, so a slow query only holds up the request waiting for it
+instead of the whole worker. Run it with an ASGI server, e.g.
+
+  uvicorn --workers=1 --host=0.0.0.0 --port=$PORT service.asgi:app
+
+Validation, query string parsing and JSON encoding are shared with the
+Flask app in service.routes, so both entry points answer these paths the
+same way. Create the tables with `flask init-db` first.
+
+Paths:
+------
+GET /promotions?{filters}&limit={n}&after={cursor}&fields={fields} - Returns the matching Promotions
+HEAD /promotions?{filters} - Returns the number of matching Promotions in X-Total-Count
+GET /promotions/count?{filters} - Returns the number of Promotions matching the list filters
+GET /promotions/{id} - Returns the Promotion with a given id number
+POST /promotions - creates a new Promotion record in the database
+PUT /promotions/{id} - updates a Promotion record in the database
+DELETE /promotions/{id} - deletes a Promotion record in the database
+PUT /promotions/{id}/invalidate - invalidates a Promotion
+"""
+import json
+import logging
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from service import app as flask_app, params, status
+from service.models import DataValidationError, Promotion
+from service.serializers import encode_list, encode_row, row_encoder
+
+logger = logging.getLogger("flask.app")
+
+CONTENT_TYPE_JSON = "application/json"
+
+table = Promotion.__table__
+ROW_COLUMNS = [table.c[field] for field in Promotion.ROW_FIELDS]
+
+
+def async_database_uri(uri):
+    """Returns the database `uri` with the asyncpg driver"""
+    return make_url(uri).set(drivername="postgresql+asyncpg")
+
+
+@asynccontextmanager
+async def lifespan(application):
+    """Opens the connection pool on startup and closes it on shutdown"""
+    config = flask_app.config
+    application.state.engine = create_async_engine(
+        async_database_uri(config["SQLALCHEMY_DATABASE_URI"]),
+        pool_size=config["ASYNC_POOL_SIZE"],
+        # queue for a pooled connection rather than open short-lived ones
+        max_overflow=0,
+    )
+    logger.info("Opened asyncpg pool of %d connections", config["ASYNC_POOL_SIZE"])
+    yield
+    await application.state.engine.dispose()
+
+
+######################################################################
+#  PATH: /promotions
+######################################################################
+async def list_promotions(request):
+    """Returns the Promotions matching the list filters, or their number for HEAD"""
+    args = request.query_params
+    if request.method == "HEAD":
+        count = await count_matching(request)
+        return Response(status_code=status.HTTP_200_OK, headers={"X-Total-Count": str(count)})
+
+    limit = params.parse_page_limit(args, flask_app.config["PAGE_SIZE_MAX"])
+    after = params.decode_cursor(args.get("after"))
+    fields = params.parse_fields(args)
+    # the id is always selected, after the requested fields, for the cursor
+    columns = fields if "id" in fields else fields + ("id",)
+    statement = (
+        select(*(table.c[field] for field in columns))
+        .where(*matching(args))
+        .order_by(table.c.id)
+    )
+    if after is not None:
+        statement = statement.where(table.c.id > after)
+    if limit is not None:
+        # fetch one extra row to find out if there is a next page
+        statement = statement.limit(limit + 1)
+    async with request.app.state.engine.connect() as connection:
+        rows = (await connection.execute(statement)).all()
+
+    headers = {}
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_url = request.url.include_query_params(
+            after=params.encode_cursor(rows[-1].id), limit=limit
+        )
+        headers["Link"] = '<{}>; rel="next"'.format(next_url)
+    encode = row_encoder(fields)
+    return json_response(encode_list([encode(row) for row in rows]), headers=headers)
+
+
+async def create_promotion(request):
+    """Creates a Promotion from the posted data"""
+    promotion = Promotion().deserialize(await read_json(request))
+    async with request.app.state.engine.begin() as connection:
+        result = await connection.execute(
+            table.insert().values(**promotion.to_row()).returning(*ROW_COLUMNS)
+        )
+        row = result.one()
+    logger.info("Promotion with ID [%s] created.", row.id)
+    location = request.url_for("get_promotion", promotion_id=row.id)
+    return json_response(
+        encode_row(row),
+        status_code=status.HTTP_201_CREATED,
+        headers={"Location": str(location)},
+    )
+
+
+######################################################################
+#  PATH: /promotions/count
+######################################################################
+async def count_promotions(request):
+    """Returns the number of Promotions matching the list filters"""
+    count = await count_matching(request)
+    return JSONResponse(
+        {"count": count, "estimated": False}, headers={"X-Total-Count": str(count)}
+    )
+
+
+######################################################################
+#  PATH: /promotions/{id}
+######################################################################
+async def get_promotion(request):
+    """Returns the Promotion with the id in the path"""
+    promotion_id = read_promotion_id(request)
+    async with request.app.state.engine.connect() as connection:
+        result = await connection.execute(select(*ROW_COLUMNS).where(table.c.id == promotion_id))
+        row = result.first()
+    if row is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Promotion not found.")
+    return json_response(encode_row(row))
+
+
+async def update_promotion(request):
+    """Replaces the Promotion with the id in the path with the posted data"""
+    promotion_id = read_promotion_id(request)
+    promotion = Promotion().deserialize(await read_json(request))
+    promotion.id = promotion_id
+    async with request.app.state.engine.begin() as connection:
+        result = await connection.execute(
+            table.update()
+            .where(table.c.id == promotion_id)
+            .values(**promotion.to_row())
+            .returning(*ROW_COLUMNS)
+        )
+        row = result.first()
+        if row is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "Promotion not found.")
+    logger.info("Promotion with id %s has been updated.", promotion_id)
+    return json_response(encode_row(row))
+
+
+async def delete_promotion(request):
+    """Deletes the Promotion with the id in the path if there is one"""
+    try:
+        promotion_id = read_promotion_id(request)
+    except HTTPException:
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    async with request.app.state.engine.begin() as connection:
+        await connection.execute(table.delete().where(table.c.id == promotion_id))
+    logger.info("Promotion with ID [%s] delete complete.", promotion_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+async def invalidate_promotion(request):
+    """Sets ongoing to False on the Promotion with the id in the path"""
+    promotion_id = read_promotion_id(request)
+    async with request.app.state.engine.begin() as connection:
+        result = await connection.execute(
+            table.update()
+            .where(table.c.id == promotion_id)
+            .values(ongoing=False)
+            .returning(*ROW_COLUMNS)
+        )
+        row = result.first()
+        if row is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "Promotion not found.")
+    logger.info("Promotion with id %s has been invalidated.", promotion_id)
+    return json_response(encode_row(row))
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def matching(args):
+    """Returns the WHERE conditions of the list filters in `args`"""
+    filters = params.list_filters(args, flask_app.config["LOOKUP_MAX_KEYS"])
+    return Promotion.matching(**filters)
+
+
+async def count_matching(request):
+    """Counts the Promotions matching the list filters of `request`"""
+    statement = select(func.count()).select_from(table).where(*matching(request.query_params))
+    async with request.app.state.engine.connect() as connection:
+        return (await connection.execute(statement)).scalar_one()
+
+
+def read_promotion_id(request):
+    """Returns the Promotion id in the path, which must be an integer"""
+    try:
+        return int(request.path_params["promotion_id"])
+    except ValueError:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Promotion not found.")
+
+
+async def read_json(request):
+    """Returns the JSON body of `request` after checking its media type"""
+    content_type = request.headers.get("Content-Type")
+    if content_type != CONTENT_TYPE_JSON:
+        logger.error("Invalid Content-Type: %s", content_type)
+        raise HTTPException(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            "Content-Type must be {}".format(CONTENT_TYPE_JSON),
+        )
+    try:
+        return json.loads(await request.body())
+    except ValueError as error:
+        raise DataValidationError("Invalid JSON: {}".format(error))
+
+
+def json_response(text, status_code=status.HTTP_200_OK, headers=None):
+    """Returns a response with JSON text that is already encoded"""
+    return Response(text, status_code=status_code, headers=headers, media_type=CONTENT_TYPE_JSON)
+
+
+######################################################################
+#  E R R O R   H A N D L E R S
+######################################################################
+def error_response(status_code, error, message):
+    """Returns an error in the same form as the Flask app"""
+    return JSONResponse(
+        {"status_code": status_code, "error": error, "message": message},
+        status_code=status_code,
+    )
+
+
+async def request_validation_error(request, error):
+    """Handles Value Errors from bad data"""
+    message = str(error)
+    logger.error(message)
+    return error_response(status.HTTP_400_BAD_REQUEST, "Bad Request", message)
+
+
+async def http_error(request, error):
+    """Handles errors raised with an HTTP status"""
+    logger.error(error.detail)
+    return error_response(error.status_code, HTTPStatus(error.status_code).phrase, error.detail)
+
+
+app = Starlette(
+    routes=[
+        Route("/promotions", list_promotions, methods=["GET", "HEAD"]),
+        Route("/promotions", create_promotion, methods=["POST"]),
+        Route("/promotions/count", count_promotions, methods=["GET"]),
+        Route("/promotions/{promotion_id}", get_promotion, methods=["GET"]),
+        Route("/promotions/{promotion_id}", update_promotion, methods=["PUT"]),
+        Route("/promotions/{promotion_id}", delete_promotion, methods=["DELETE"]),
+        Route("/promotions/{promotion_id}/invalidate", invalidate_promotion, methods=["PUT"]),
+    ],
+    exception_handlers={
+        DataValidationError: request_validation_error,
+        HTTPException: http_error,
+    },
+    lifespan=lifespan,
+)
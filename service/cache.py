@@ -0,0 +1,210 @@
+"""
+Query result cache
+
+Keeps serialized query results in process so repeated reads skip the
+database. Entries are tagged with the Promotions and products they were
+built from, and writes evict exactly the tags they touch.
+
+Classes
+-------
+NullBackend - a backend that never stores anything (caching disabled)
+LRUBackend - a size bounded LRU backend whose entries expire after a TTL
+ResultCache - the cache used by the service, counting hits and misses
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+# tag of results that may contain any Promotion, such as unfiltered lists
+LIST_TAG = "list"
+
+
+def promotion_tag(promotion_id):
+    """Tag of results that contain the Promotion with `promotion_id`"""
+    return "promotion:{}".format(promotion_id)
+
+
+def product_tag(product_id):
+    """Tag of results that contain Promotions of the product `product_id`"""
+    return "product:{}".format(product_id)
+
+
+class NullBackend:
+    """A backend that stores nothing"""
+
+    evictions = 0
+
+    def __len__(self):
+        return 0
+
+    def get(self, key):
+        """Always misses"""
+        return None
+
+    def set(self, key, value, tags):
+        """Drops the value"""
+
+    def invalidate(self, tags):
+        """Has nothing to evict"""
+        return 0
+
+    def clear(self):
+        """Has nothing to clear"""
+
+
+class LRUBackend:
+    """
+    Stores up to `max_size` entries for at most `ttl` seconds
+
+    The least recently used entry is evicted when the cache is full.
+    """
+
+    def __init__(self, max_size=1024, ttl=30.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._tags = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the value stored under `key`, or None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value, _ = entry
+        if expires <= self._clock():
+            self._discard(key)
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, tags):
+        """Stores `value` under `key` and files it under every tag"""
+        self._discard(key)
+        self._entries[key] = (self._clock() + self.ttl, value, tuple(tags))
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, tags):
+        """Evicts every entry filed under any of `tags`"""
+        count = 0
+        for tag in tags:
+            for key in self._tags.pop(tag, ()):
+                if key in self._entries:
+                    self._discard(key)
+                    count += 1
+        return count
+
+    def clear(self):
+        """Evicts every entry"""
+        self._entries.clear()
+        self._tags.clear()
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class ResultCache:
+    """
+    The result cache of the service
+
+    Delegates storage to a pluggable backend with the get, set, invalidate
+    and clear methods of LRUBackend, and counts how well it performs.
+    """
+
+    def __init__(self, backend=None):
+        self._lock = threading.Lock()
+        self.use(NullBackend() if backend is None else backend)
+
+    def use(self, backend):
+        """Switches to `backend` and resets the counters"""
+        with self._lock:
+            self.backend = backend
+            self.generation = 0
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+
+    @property
+    def enabled(self):
+        """True unless caching is disabled"""
+        return not isinstance(self.backend, NullBackend)
+
+    def get(self, key):
+        """Returns the value cached under `key`, or None"""
+        with self._lock:
+            value = self.backend.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value, tags, generation=None):
+        """Caches `value` under `key` tagged with `tags`
+
+        Pass the `generation` read before building `value` to skip caching
+        it when a write invalidated the cache in the meantime.
+        """
+        with self._lock:
+            if generation is None or generation == self.generation:
+                self.backend.set(key, value, tags)
+
+    def invalidate(self, *tags):
+        """Evicts every entry tagged with any of `tags`"""
+        with self._lock:
+            self.generation += 1
+            self.invalidations += self.backend.invalidate(tags)
+
+    def clear(self):
+        """Evicts every entry"""
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self.backend)
+            self.backend.clear()
+
+    def stats(self):
+        """Returns the counters of the cache"""
+        with self._lock:
+            return {
+                "backend": type(self.backend).__name__,
+                "size": len(self.backend),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.backend.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+def configure_cache(app):
+    """Picks the cache backend from the RESULT_CACHE_* settings of `app`"""
+    size = app.config.get("RESULT_CACHE_SIZE", 0)
+    if size > 0:
+        ttl = app.config.get("RESULT_CACHE_TTL", 30.0)
+        logger.info("Caching up to %d results for %s seconds", size, ttl)
+        result_cache.use(LRUBackend(size, ttl))
+    else:
+        result_cache.use(NullBackend())
+
+
+# the cache shared by the whole process
+result_cache = ResultCache()
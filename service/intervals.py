@@ -0,0 +1,360 @@
+"""
+In-memory index of Promotion validity windows
+
+Answers "which Promotions are active on a date" without a round trip to the
+database. Windows are kept in a centered interval tree, so a lookup costs
+O(log n + k) for k matches.
+
+Classes
+-------
+IntervalIndex - a stabbing-query index over (start, end) intervals
+ActivePromotionIndex - the per-process index of Promotions by validity window
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger("flask.app")
+
+# open-ended promotions (end_date is NULL) never end
+OPEN_END = datetime.max
+
+
+class _Node:
+    """A node of a centered interval tree"""
+
+    __slots__ = ("center", "by_start", "by_end", "left", "right")
+
+    def __init__(self, center, intervals, left, right):
+        self.center = center
+        # intervals containing the center, ordered for early exit
+        self.by_start = sorted(intervals, key=lambda interval: interval[0])
+        self.by_end = sorted(intervals, key=lambda interval: interval[1], reverse=True)
+        self.left = left
+        self.right = right
+
+
+def _build(intervals):
+    """Builds a centered interval tree from a list of (start, end, key)"""
+    if not intervals:
+        return None
+    endpoints = sorted(
+        endpoint for interval in intervals for endpoint in (interval[0], interval[1])
+    )
+    center = endpoints[len(endpoints) // 2]
+    left, right, middle = [], [], []
+    for interval in intervals:
+        if interval[1] < center:
+            left.append(interval)
+        elif interval[0] > center:
+            right.append(interval)
+        else:
+            middle.append(interval)
+    return _Node(center, middle, _build(left), _build(right))
+
+
+def _stab(node, point, found):
+    """Collects the keys of every interval in the tree containing `point`"""
+    while node is not None:
+        if point < node.center:
+            for start, _, key in node.by_start:
+                if start > point:
+                    break
+                found.append(key)
+            node = node.left
+        elif point > node.center:
+            for _, end, key in node.by_end:
+                if end < point:
+                    break
+                found.append(key)
+            node = node.right
+        else:
+            found.extend(key for _, _, key in node.by_start)
+            return
+
+
+class IntervalIndex:
+    """
+    Finds the keys of the closed intervals containing a point
+
+    The tree is static, so intervals added or removed after it was built
+    are kept aside and merged into queries until enough of them pile up
+    to make a rebuild worthwhile.
+    """
+
+    def __init__(self, rebuild_threshold=32):
+        self.rebuild_threshold = rebuild_threshold
+        self._intervals = {}
+        self._tree = None
+        self._tree_keys = set()
+        self._pending = {}
+        self._removed = set()
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def add(self, key, start, end):
+        """Adds the interval [start, end] under `key`, replacing any previous one"""
+        self.remove(key)
+        self._intervals[key] = (start, end)
+        self._pending[key] = (start, end, key)
+        self._maybe_rebuild()
+
+    def remove(self, key):
+        """Removes the interval stored under `key` if there is one"""
+        if self._intervals.pop(key, None) is None:
+            return
+        self._pending.pop(key, None)
+        if key in self._tree_keys:
+            self._removed.add(key)
+        self._maybe_rebuild()
+
+    def load(self, intervals):
+        """Replaces the contents of the index with (start, end, key) intervals"""
+        self._intervals = {key: (start, end) for start, end, key in intervals}
+        self.rebuild()
+
+    def overlapping(self, point):
+        """Returns the keys of every interval containing `point`"""
+        found = []
+        _stab(self._tree, point, found)
+        if self._removed:
+            found = [key for key in found if key not in self._removed]
+        found.extend(
+            key for start, end, key in self._pending.values() if start <= point <= end
+        )
+        return found
+
+    def rebuild(self):
+        """Rebuilds the tree from every interval in the index"""
+        intervals = [(start, end, key) for key, (start, end) in self._intervals.items()]
+        self._tree = _build(intervals)
+        self._tree_keys = set(self._intervals)
+        self._pending = {}
+        self._removed = set()
+
+    def _maybe_rebuild(self):
+        changes = len(self._pending) + len(self._removed)
+        if changes > max(self.rebuild_threshold, len(self._intervals) // 16):
+            self.rebuild()
+
+
+def naive_utc(date):
+    """Converts `date` to the naive UTC form the database stores"""
+    if date is not None and date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+class ActivePromotionIndex:
+    """
+    Keeps every Promotion of this process indexed by its validity window
+
+    The index is disabled until enable(), and loaded by the first lookup
+    after it. Single Promotion writes update it in place; bulk writes mark
+    it stale so the next lookup reloads it. Other processes cannot notify it of their writes, so it is also
+    reloaded once it is older than `max_age` seconds.
+
+    A reload reads the database and builds the new trees without holding
+    the lock, so lookups keep answering from the previous contents and
+    writes are not held up meanwhile. The writes made during the build are
+    recorded and applied again to the new contents before they replace the
+    old ones.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.max_age = None
+        self._loader = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        # held by the one thread reloading the index
+        self._reload_lock = threading.Lock()
+        # bumped by enable() and disable(), whose contents a reload must not undo
+        self._epoch = 0
+        # bumped by mark_stale(), so a reload that started before knows it missed writes
+        self._stale_marks = 0
+        # the writes made while a reload runs, None when none runs
+        self._journal = None
+        self._promotions = None
+        self._windows = IntervalIndex()
+        self._products = {}
+
+    def enable(self, loader, max_age=None):
+        """Turns the index on; the first lookup loads it
+
+        Args:
+            loader (callable): returns every Promotion in the database
+            max_age (float): seconds before the index is reloaded, or None
+        """
+        with self._lock:
+            self._loader = loader
+            self.max_age = max_age
+            self.enabled = True
+            self._clear()
+
+    def disable(self):
+        """Turns the index off and drops its contents"""
+        with self._lock:
+            self.enabled = False
+            self._loader = None
+            self._clear()
+
+    def reload(self):
+        """Rebuilds the index from every Promotion returned by the loader"""
+        with self._reload_lock:
+            self._rebuild()
+
+    def mark_stale(self):
+        """Forces a reload before the next lookup"""
+        with self._lock:
+            self._loaded_at = None
+            self._stale_marks += 1
+
+    def add(self, promotion):
+        """Adds or replaces a Promotion after it has been saved"""
+        if not self.enabled:
+            return
+        # reading the saved row may query the database, so not under the lock
+        entry = self._entry(promotion)
+        self._write(promotion.id, entry)
+
+    def remove(self, promotion_id):
+        """Removes a Promotion after it has been deleted"""
+        if not self.enabled:
+            return
+        self._write(promotion_id, None)
+
+    def active_on(self, date, product_id=None):
+        """Returns the serialized Promotions active on `date`, ordered by id
+
+        Args:
+            date (datetime): the moment the Promotions must be active at
+            product_id (int): only return Promotions applied to this product
+        """
+        date = naive_utc(date)
+        self._refresh()
+        with self._lock:
+            if product_id is None:
+                windows = self._windows
+            else:
+                windows = self._products.get(product_id)
+                if windows is None:
+                    return []
+            return [self._promotions[key] for key in sorted(windows.overlapping(date))]
+
+    def _refresh(self):
+        """Reloads a stale index; only waits for another reload when it was never loaded"""
+        if self._fresh():
+            return
+        with self._lock:
+            loaded = self._promotions is not None
+        # while another thread reloads, answer from the current contents
+        if not self._reload_lock.acquire(blocking=not loaded):
+            return
+        try:
+            if not self._fresh():
+                self._rebuild()
+        finally:
+            self._reload_lock.release()
+
+    def _fresh(self):
+        with self._lock:
+            loaded_at = self._loaded_at
+        return loaded_at is not None and (
+            self.max_age is None or time.monotonic() - loaded_at <= self.max_age
+        )
+
+    def _rebuild(self):
+        """Loads and builds new contents without the lock, then swaps them in"""
+        with self._lock:
+            loader = self._loader
+            epoch = self._epoch
+            stale_marks = self._stale_marks
+            self._journal = []
+        try:
+            promotions = {}
+            windows = []
+            products = {}
+            for promotion in loader():
+                window, serialized = self._entry(promotion)
+                promotions[promotion.id] = serialized
+                windows.append(window)
+                products.setdefault(promotion.product_id, []).append(window)
+            all_windows = IntervalIndex()
+            all_windows.load(windows)
+            product_windows = {}
+            for product_id, windows in products.items():
+                product_windows[product_id] = IntervalIndex()
+                product_windows[product_id].load(windows)
+        except Exception:
+            with self._lock:
+                self._journal = None
+            raise
+        with self._lock:
+            journal, self._journal = self._journal, None
+            if self._epoch != epoch:
+                # enabled or disabled again while loading
+                return
+            self._promotions = promotions
+            self._windows = all_windows
+            self._products = product_windows
+            for promotion_id, entry in journal:
+                self._apply(promotion_id, entry)
+            # a bulk write during the build may be missing, so stay stale
+            if self._stale_marks == stale_marks:
+                self._loaded_at = time.monotonic()
+            count = len(promotions)
+        logger.info("Indexed %d promotions by active window", count)
+
+    @staticmethod
+    def _window(promotion):
+        start = naive_utc(promotion.start_date)
+        end = naive_utc(promotion.end_date) or OPEN_END
+        return start, end, promotion.id
+
+    def _entry(self, promotion):
+        """Returns the window and serialized form of a Promotion"""
+        return self._window(promotion), promotion.serialize()
+
+    def _write(self, promotion_id, entry):
+        """Applies a single write, and records it for a reload in progress"""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((promotion_id, entry))
+            self._apply(promotion_id, entry)
+
+    def _apply(self, promotion_id, entry):
+        """Replaces the Promotion with `promotion_id` by `entry`, or removes it for None"""
+        if self._promotions is None:
+            return
+        self._discard(promotion_id)
+        if entry is None:
+            return
+        (start, end, key), serialized = entry
+        self._promotions[key] = serialized
+        self._windows.add(key, start, end)
+        self._products.setdefault(serialized["product_id"], IntervalIndex()).add(key, start, end)
+
+    def _discard(self, promotion_id):
+        previous = self._promotions.pop(promotion_id, None)
+        if previous is None:
+            return
+        self._windows.remove(promotion_id)
+        windows = self._products.get(previous["product_id"])
+        windows.remove(promotion_id)
+        if not len(windows):
+            del self._products[previous["product_id"]]
+
+    def _clear(self):
+        # None until the first reload, so lookups wait for it
+        self._promotions = None
+        self._windows = IntervalIndex()
+        self._products = {}
+        self._loaded_at = None
+        self._epoch += 1
+
+
+# the index shared by the whole process
+active_index = ActivePromotionIndex()
@@ -0,0 +1,140 @@
+"""
+Request metrics in the Prometheus text exposition format
+
+Times every request and counts its status code and response size per
+route and method. Routes are labeled with their URL rule, such as
+/promotions/<promotion_id>, so the number of series stays bounded.
+
+With several gunicorn workers, set PROMETHEUS_MULTIPROC_DIR to a directory
+shared by the workers before they start (gunicorn.conf.py does); every
+worker then writes its samples there and /metrics adds them up.
+"""
+import os
+import time
+
+from flask import g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess,
+)
+
+# label of requests that matched no route, such as most 404s
+UNMATCHED_ROUTE = "<unmatched>"
+# label of the methods clients make up, which would add a series each
+OTHER_METHOD = "OTHER"
+KNOWN_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+
+REQUEST_LATENCY = Histogram(
+    "promotions_http_request_duration_seconds",
+    "Time spent handling a request",
+    ["method", "route"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+REQUESTS = Counter(
+    "promotions_http_requests",
+    "Requests handled, by status code",
+    ["method", "route", "status"],
+)
+IN_FLIGHT = Gauge(
+    "promotions_http_requests_in_flight",
+    "Requests being handled right now",
+    ["method", "route"],
+    multiprocess_mode="livesum",
+)
+RESPONSE_SIZE = Histogram(
+    "promotions_http_response_size_bytes",
+    "Size of the response bodies whose length is known up front",
+    ["method", "route"],
+    buckets=(100, 1000, 10000, 100000, 1000000, 10000000),
+)
+
+
+def instrument(app):
+    """Records the metrics of every request `app` handles"""
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(end_request)
+
+
+class RouteMetrics:
+    """The metrics of one route and method
+
+    Looking the labeled metrics up once per route instead of on every
+    request keeps the cost of recording a request low.
+    """
+
+    def __init__(self, method, route):
+        self.labels = (method, route)
+        self.latency = REQUEST_LATENCY.labels(method, route)
+        self.in_flight = IN_FLIGHT.labels(method, route)
+        self.size = RESPONSE_SIZE.labels(method, route)
+        self.requests = {}
+
+    def count(self, status_code):
+        """Counts a response with `status_code`"""
+        counter = self.requests.get(status_code)
+        if counter is None:
+            counter = self.requests[status_code] = REQUESTS.labels(*self.labels, str(status_code))
+        counter.inc()
+
+
+_route_metrics = {}
+
+
+def route_metrics(method, rule):
+    """Returns the metrics of requests for `method` that matched `rule`"""
+    if method not in KNOWN_METHODS:
+        method = OTHER_METHOD
+    key = (method, UNMATCHED_ROUTE if rule is None else rule.rule)
+    metrics = _route_metrics.get(key)
+    if metrics is None:
+        metrics = _route_metrics[key] = RouteMetrics(*key)
+    return metrics
+
+
+def start_request():
+    """Starts timing the request and counts it as in flight"""
+    current = request._get_current_object()
+    if current.endpoint == "metrics_view":
+        return
+    metrics = route_metrics(current.method, current.url_rule)
+    metrics.in_flight.inc()
+    g.metrics = (metrics, time.perf_counter())
+
+
+def finish_request(response):
+    """Records the latency, status code and size of the response
+
+    Streamed responses are timed until the view returns them, and their
+    size is not known up front, so it is not recorded.
+    """
+    started = g.get("metrics")
+    if started is not None:
+        metrics, start = started
+        metrics.latency.observe(time.perf_counter() - start)
+        metrics.count(response.status_code)
+        size = response.content_length
+        if size is not None:
+            metrics.size.observe(size)
+    return response
+
+
+def end_request(error=None):
+    """Counts the request as done, whether or not it failed"""
+    started = g.pop("metrics", None)
+    if started is not None:
+        started[0].in_flight.dec()
+
+
+def exposition():
+    """Returns every metric of the service in the text exposition format
+
+    Returns:
+        tuple: the body and its content type
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
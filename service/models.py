@@ -21,24 +21,49 @@ product_id (Integer) - product id that's part of the promotion
 
 """
 import os
+import re
 import json
 import logging
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from enum import Enum
-from sqlalchemy import and_
+from functools import lru_cache
+from sqlalchemy import and_, func, inspect, or_, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
 
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+
+from service.cache import LIST_TAG, configure_cache, product_tag, promotion_tag, result_cache
+from service.intervals import active_index, naive_utc
+from service.pool import InstrumentedQueuePool, pool_stats
+from service.queries import query_log
+from service.replicas import RoutingSQLAlchemy, replicas
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy(engine_options={"poolclass": InstrumentedQueuePool})
 
 
 def init_db(app):
-    """Initialize the SQLAlchemy app"""
+    """Initialize the SQLAlchemy app and create its tables"""
     Promotion.init_db(app)
+    Promotion.create_schema()
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) of a statement, executed like the statement itself"""
+
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kw):
+    """Prefixes the compiled statement with EXPLAIN, keeping its bound parameters"""
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
 
 
 class DatabaseConnectionError(Exception):
@@ -57,6 +82,10 @@ class Type(Enum):
     UNKNOWN = 3
 
 
+# hands out the versions of Promotion rows, so every write gets a new one
+VERSION_SEQUENCE = db.Sequence("promotion_version_seq", metadata=db.metadata)
+
+
 class Promotion(db.Model):
     """
     Class that represents a Promotion
@@ -80,6 +109,32 @@ class Promotion(db.Model):
     # True for promotions that are ongoing
     ongoing = db.Column(db.Boolean, nullable=False)
     product_id = db.Column(db.Integer, nullable=False)
+    # a new value from VERSION_SEQUENCE on every insert and update, so
+    # ETags can be checked without reading and encoding the rows
+    version = db.Column(
+        db.BigInteger,
+        nullable=False,
+        server_default=text("nextval('promotion_version_seq')"),
+        onupdate=VERSION_SEQUENCE.next_value(),
+    )
+
+    # the columns of a Promotion row, in the order as_rows() returns them
+    ROW_FIELDS = (
+        "id", "name", "start_date", "end_date", "type", "value", "ongoing", "product_id"
+    )
+
+    # one index per finder so none of them has to scan the whole table; the
+    # trailing id lets keyset pages of one product or name seek to `after`
+    # and read the next rows in id order without sorting
+    __table_args__ = (
+        db.Index("ix_promotion_product_id_id", "product_id", "id"),
+        db.Index("ix_promotion_name_id", "name", "id"),
+        # find_active: start_date <= date AND end_date >= date; its leading
+        # start_date column also serves find_by_start_date
+        db.Index("ix_promotion_active_window", "start_date", "end_date"),
+    )
+    # indexes of earlier versions that create_indexes() drops
+    RETIRED_INDEXES = ("ix_promotion_product_id", "ix_promotion_name")
 
     ##################################################
     # INSTANCE METHODS
@@ -96,19 +151,47 @@ class Promotion(db.Model):
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
         db.session.commit()
+        active_index.add(self)
+        result_cache.invalidate(LIST_TAG, promotion_tag(self.id), product_tag(self.product_id))
 
     def update(self):
         """
         Updates a Promotion to the database
         """
         logger.info("Saving %s", self.name)
+        # results of the product the Promotion moved away from are stale too
+        tags = self._cache_tags()
         db.session.commit()
+        active_index.add(self)
+        result_cache.invalidate(*tags)
 
     def delete(self):
         """ Removes a Promotion from the data store """
         logger.info("Deleting %s", self.name)
+        promotion_id = self.id
+        tags = self._cache_tags()
         db.session.delete(self)
         db.session.commit()
+        active_index.remove(promotion_id)
+        result_cache.invalidate(*tags)
+
+    def _cache_tags(self):
+        """ Returns the tags of every cached result this Promotion may be part of """
+        history = inspect(self).attrs.product_id.history
+        product_ids = set(history.added or ()) | set(history.deleted or ()) | set(history.unchanged or ())
+        return [LIST_TAG, promotion_tag(self.id)] + [product_tag(p) for p in product_ids]
+
+    def to_row(self):
+        """ Returns the column values of a Promotion for a Core INSERT """
+        return {
+            'name': self.name,
+            'start_date': naive_utc(self.start_date),
+            'end_date': naive_utc(self.end_date),
+            'type': self.type,
+            'value': self.value,
+            'ongoing': self.ongoing,
+            'product_id': self.product_id,
+        }
 
     def serialize(self):
         """ Serializes a Promotion into a dictionary """
@@ -143,16 +226,16 @@ class Promotion(db.Model):
                     + str(type(data['name']))
                 )
             if isinstance(data['start_date'], str):
-                self.start_date = parse_datetime_optional_timezone(
-                    data['start_date'])
+                self.start_date = naive_utc(parse_datetime_optional_timezone(
+                    data['start_date']))
             else:
                 raise DataValidationError(
                     "Invalid type for string [start_date]: "
                     + str(type(data['start_date']))
                 )
             if isinstance(data['end_date'], str):
-                self.end_date = parse_datetime_optional_timezone(
-                    data['end_date'])
+                self.end_date = naive_utc(parse_datetime_optional_timezone(
+                    data['end_date']))
             elif data['end_date'] is None:
                 self.end_date = None
             else:
@@ -215,6 +298,10 @@ class Promotion(db.Model):
     def init_db(cls, app: Flask):
         """Initializes the database session
 
+        Nothing is sent to the database: connections are opened by the
+        first query that needs one, and the tables are created separately
+        by create_schema().
+
         :param app: the Flask app
         :type data: Flask
 
@@ -223,7 +310,88 @@ class Promotion(db.Model):
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
+        pool_stats.watch(db.engine)
+        query_log.watch(db.engine, app.config.get("SLOW_QUERY_SECONDS"))
+        replicas.configure(
+            app.config.get("DATABASE_REPLICA_URIS"),
+            app.config.get("SQLALCHEMY_ENGINE_OPTIONS"),
+            app.config.get("REPLICA_CHECK_SECONDS", 5.0),
+            app.config.get("REPLICA_STICKY_SECONDS", 10),
+        )
+        for replica in replicas.replicas:
+            query_log.watch(replica.engine)
+        configure_cache(app)
+        if app.config.get("ACTIVE_INDEX_ENABLED"):
+            active_index.enable(
+                lambda: cls.stream(cls.query_all()),
+                app.config.get("ACTIVE_INDEX_MAX_AGE"),
+            )
+        else:
+            active_index.disable()
+
+    @classmethod
+    def create_schema(cls):
+        """Creates the tables and indexes that do not exist yet"""
+        logger.info("Creating database tables")
         db.create_all()  # make our sqlalchemy tables
+        cls.create_columns()
+        cls.create_indexes()
+
+    @classmethod
+    def create_columns(cls):
+        """Adds the version column to a Promotion table that predates it
+
+        The column is filled from the sequence for every existing row, so
+        adding it rewrites the table under an exclusive lock once.
+        """
+        with db.engine.begin() as conn:
+            columns = {column["name"] for column in inspect(conn).get_columns(cls.__tablename__)}
+            if "version" in columns:
+                return
+            logger.info("Adding the version column")
+            conn.execute(text(
+                "ALTER TABLE promotion ADD COLUMN version bigint NOT NULL"
+                " DEFAULT nextval('promotion_version_seq')"
+            ))
+
+    @classmethod
+    def create_indexes(cls):
+        """Creates any missing index on an existing Promotion table
+
+        db.create_all() only creates indexes together with a new table, so
+        deployments whose table predates an index get it added here. The
+        indexes are built with CREATE INDEX CONCURRENTLY, which does not
+        block writes to the table but cannot run inside a transaction, so
+        each statement is committed on its own. A build that was
+        interrupted leaves an invalid index behind, which is dropped and
+        built again; indexes replaced by newer ones are dropped the same way.
+        """
+        table = cls.__table__
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            existing = dict(conn.execute(
+                text(
+                    "SELECT c.relname, i.indisvalid FROM pg_index i"
+                    " JOIN pg_class c ON c.oid = i.indexrelid"
+                    " WHERE i.indrelid = CAST(:table AS regclass)"
+                ),
+                {"table": table.name},
+            ).fetchall())
+            for name in cls.RETIRED_INDEXES:
+                if name in existing:
+                    logger.info("Dropping index %s", name)
+                    conn.execute(text('DROP INDEX CONCURRENTLY IF EXISTS "{}"'.format(name)))
+            for index in table.indexes:
+                if existing.get(index.name):
+                    continue
+                if index.name in existing:
+                    logger.warning("Rebuilding invalid index %s", index.name)
+                    conn.execute(text('DROP INDEX CONCURRENTLY IF EXISTS "{}"'.format(index.name)))
+                logger.info("Creating index %s", index.name)
+                conn.execute(text('CREATE INDEX CONCURRENTLY "{}" ON "{}" ({})'.format(
+                    index.name,
+                    table.name,
+                    ", ".join('"{}"'.format(column.name) for column in index.columns),
+                )))
 
     @classmethod
     def all(cls):
@@ -231,6 +399,206 @@ class Promotion(db.Model):
         logger.info("Processing all Promotions")
         return cls.query.all()
 
+    @classmethod
+    def bulk_create(cls, promotions, batch_size=1000):
+        """Creates many Promotions in a single transaction
+
+        Promotions are written with multi-row INSERT statements of up to
+        `batch_size` rows each and committed once at the end, so either
+        every Promotion is created or none is. Their ids are drawn from the
+        id sequence first and inserted explicitly, as Postgres does not
+        promise to return generated ids in the order of the VALUES.
+
+        Args:
+            promotions (list): the Promotions to create
+            batch_size (int): the number of rows per INSERT statement
+
+        Returns:
+            list: the ids generated for the Promotions, in order
+        """
+        logger.info("Creating %d Promotions in bulk", len(promotions))
+        table = cls.__table__
+        try:
+            ids = cls.reserve_ids(len(promotions))
+            for start in range(0, len(promotions), batch_size):
+                rows = [
+                    dict(promotion.to_row(), id=promotion_id)
+                    for promotion, promotion_id in zip(
+                        promotions[start:start + batch_size], ids[start:start + batch_size]
+                    )
+                ]
+                db.session.execute(table.insert().values(rows))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        active_index.mark_stale()
+        result_cache.invalidate(
+            LIST_TAG,
+            *[promotion_tag(promotion_id) for promotion_id in ids],
+            *{product_tag(promotion.product_id) for promotion in promotions},
+        )
+        return ids
+
+    @classmethod
+    def reserve_ids(cls, count):
+        """Returns `count` new ids from the sequence of the id column"""
+        if not count:
+            return []
+        result = db.session.execute(
+            text(
+                "SELECT nextval(pg_get_serial_sequence('promotion', 'id'))"
+                " FROM generate_series(1, :count)"
+            ),
+            {"count": count},
+        )
+        return [row[0] for row in result]
+
+    @classmethod
+    def delete_matching(cls, query):
+        """Removes every Promotion matched by `query` with one DELETE
+
+        Returns:
+            int: the number of Promotions deleted
+        """
+        logger.info("Deleting Promotions in bulk")
+        count = query.delete(synchronize_session=False)
+        db.session.commit()
+        active_index.mark_stale()
+        result_cache.clear()
+        return count
+
+    @classmethod
+    def invalidate_matching(cls, query):
+        """Sets ongoing to False on every Promotion matched by `query` with one UPDATE
+
+        Returns:
+            int: the number of Promotions invalidated
+        """
+        logger.info("Invalidating Promotions in bulk")
+        count = query.update({cls.ongoing: False}, synchronize_session=False)
+        db.session.commit()
+        active_index.mark_stale()
+        result_cache.clear()
+        return count
+
+    @classmethod
+    def query_all(cls):
+        """ Returns a query over all of the Promotions in the database """
+        logger.info("Processing query for all Promotions")
+        return cls.query
+
+    @classmethod
+    def paginate(cls, query, after=None, limit=None):
+        """Returns one page of `query` using keyset pagination on the id
+
+        Rows are always ordered by id, so a page is located with an index
+        seek on the primary key no matter how deep the client pages. Pages
+        filtered by product_id or name seek the same way on
+        ix_promotion_product_id_id or ix_promotion_name_id; other filters
+        are checked on the rows read in id order.
+
+        Args:
+            query (Query): the query to paginate
+            after (int): only return Promotions whose id is greater than this
+            limit (int): the maximum number of Promotions to return
+        """
+        logger.info("Processing page after id %s with limit %s ...", after, limit)
+        query = query.order_by(cls.id)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def as_rows(cls, query):
+        """Makes `query` return plain ROW_FIELDS tuples instead of Promotions
+
+        Rows skip building ORM objects and tracking them in the session,
+        which is all a read-only listing needs.
+        """
+        return query.with_entities(*(getattr(cls, field) for field in cls.ROW_FIELDS))
+
+    @classmethod
+    def project(cls, query, fields, batch_size=None):
+        """Runs `query` as a Core SELECT of only the columns named in `fields`
+
+        The statement is executed without the ORM, so the result holds
+        lightweight rows in the order of `fields` and nothing is added to
+        the identity map of the session.
+
+        Args:
+            query (Query): the query whose filters and ordering to keep
+            fields (tuple): the names of the columns to select
+            batch_size (int): stream the rows from a server-side cursor
+                this many at a time instead of fetching them all at once
+        """
+        columns = [cls.__table__.c[field] for field in fields]
+        statement = query.with_entities(*columns).statement
+        if batch_size is None:
+            return db.session.execute(statement)
+        logger.info("Streaming projection in batches of %d ...", batch_size)
+        statement = statement.execution_options(stream_results=True)
+        return db.session.execute(statement).yield_per(batch_size)
+
+    @classmethod
+    def version_of(cls, promotion_id):
+        """Returns the version of the Promotion with `promotion_id`, or None"""
+        return db.session.query(cls.version).filter(cls.id == promotion_id).scalar()
+
+    @classmethod
+    def versions(cls, query):
+        """Returns the number of rows `query` returns and the sum of their versions
+
+        Every write gives its row a new, higher version, so the pair
+        changes whenever a row is added to, changed in or removed from the
+        result, while only the id and version of its rows are read.
+        """
+        subquery = query.with_entities(cls.id, cls.version).subquery()
+        return db.session.query(
+            func.count(), func.coalesce(func.sum(subquery.c.version), 0)
+        ).one()
+
+    @classmethod
+    def count(cls, query):
+        """Returns the number of Promotions `query` matches
+
+        Runs SELECT count(*) with the filters of `query` and nothing else,
+        so the database can count the entries of the index that answers
+        the filters instead of reading whole rows.
+        """
+        logger.info("Processing count query ...")
+        counting = db.session.query(func.count()).select_from(cls)
+        if query.whereclause is not None:
+            counting = counting.filter(query.whereclause)
+        return counting.scalar()
+
+    @classmethod
+    def estimate_count(cls, query):
+        """Returns the planner's estimate of the number of Promotions `query` matches
+
+        The estimate comes from the table statistics gathered by ANALYZE
+        and costs no more than planning the query, however large the table.
+        """
+        logger.info("Processing count estimate ...")
+        plan = db.session.execute(Explain(query.order_by(None).statement)).scalar()
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    @classmethod
+    def stream(cls, query, batch_size=1000):
+        """Iterates over `query` without loading every row at once
+
+        Rows are read from a server-side cursor `batch_size` at a time, so
+        memory stays flat however many Promotions the query matches.
+
+        Args:
+            query (Query): the query to stream
+            batch_size (int): the number of rows fetched per round trip
+        """
+        logger.info("Streaming query in batches of %d ...", batch_size)
+        return query.execution_options(stream_results=True).yield_per(batch_size)
+
     @classmethod
     def find(cls, by_id):
         """ Finds a Promotion by it's ID """
@@ -254,18 +622,100 @@ class Promotion(db.Model):
         return cls.query.filter(cls.name == name)
 
     @classmethod
-    def find_active(cls, date):
-        """ Returns the promotions active on a certain date"""
-        if isinstance(date, str) or not isinstance(date, datetime.datetime):
+    def find_active(cls, date, product_id=None):
+        """Returns the promotions active on a certain date
+
+        Promotions without an end_date are active from their start_date on.
+
+        Args:
+            date (datetime or string): the date the Promotions are active on
+            product_id (int or list): only return Promotions applied to this
+                product, or to any of these products
+        """
+        if not isinstance(date, datetime):
             date = parse_datetime_optional_timezone(date)
         logger.info("Processing date query for %s ...", date)
-        return cls.query.filter(and_(cls.start_date <= date, cls.end_date >= date))
+        query = cls.query.filter(cls.active_on(date))
+        if isinstance(product_id, (list, tuple)):
+            query = query.filter(cls.product_id.in_(product_id))
+        elif product_id is not None:
+            query = query.filter(cls.product_id == product_id)
+        return query
+
+    @classmethod
+    def active_on(cls, date):
+        """Returns the condition of a Promotion being active on `date`
+
+        The range on start_date and end_date is answered by the
+        ix_promotion_active_window index.
+        """
+        date = naive_utc(date)
+        return and_(cls.start_date <= date, or_(cls.end_date.is_(None), cls.end_date >= date))
+
+    @classmethod
+    def find_matching(cls, **filters):
+        """Returns the Promotions matching every filter that is not None
+
+        All of the filters are combined with AND into a single query. The
+        ids, product_ids, name, start_date and active_on predicates have
+        the same form as in the single filter finders, so the planner can
+        answer them with the primary key, ix_promotion_product_id_id,
+        ix_promotion_name_id or ix_promotion_active_window, whichever is
+        the most selective, and checks the other predicates on the rows found.
+
+        Takes the keyword arguments of matching().
+        """
+        conditions = cls.matching(**filters)
+        logger.info("Processing query with %d filters ...", len(conditions))
+        return cls.query.filter(*conditions)
+
+    @classmethod
+    def matching(cls, ids=None, product_ids=None, name=None, start_date=None,
+                 active_on=None, promotion_type=None, ongoing=None,
+                 value_min=None, value_max=None):
+        """Returns the WHERE conditions of the filters that are not None
+
+        Args:
+            ids (list): only return Promotions with any of these ids
+            product_ids (list): only return Promotions of any of these products
+            name (string): only return Promotions with this name
+            start_date (datetime): only return Promotions starting at this date
+            active_on (datetime): only return Promotions active on this date
+            promotion_type (Type): only return Promotions of this type
+            ongoing (bool): only return Promotions that are, or are not, ongoing
+            value_min (float): only return Promotions with at least this value
+            value_max (float): only return Promotions with at most this value
+        """
+        conditions = []
+        if ids is not None:
+            conditions.append(cls.id.in_(ids))
+        if product_ids is not None:
+            if len(product_ids) == 1:
+                conditions.append(cls.product_id == product_ids[0])
+            else:
+                conditions.append(cls.product_id.in_(product_ids))
+        if name is not None:
+            conditions.append(cls.name == name)
+        if start_date is not None:
+            conditions.append(cls.start_date == naive_utc(start_date))
+        if active_on is not None:
+            conditions.append(cls.active_on(active_on))
+        if promotion_type is not None:
+            conditions.append(cls.type == promotion_type)
+        if ongoing is not None:
+            conditions.append(cls.ongoing.is_(ongoing))
+        if value_min is not None:
+            conditions.append(cls.value >= value_min)
+        if value_max is not None:
+            conditions.append(cls.value <= value_max)
+        return conditions
 
     @classmethod
     def find_by_start_date(cls, date):
         """ Finds a Promotion by it's start_date """
-        if isinstance(date, str) or not isinstance(date, datetime.datetime):
+        if not isinstance(date, datetime):
             date = parse_datetime_optional_timezone(date)
+        date = naive_utc(date)
         logger.info("Processing lookup for start_date %s ...", date)
         return cls.query.filter(cls.start_date == date)
 
@@ -279,13 +729,76 @@ class Promotion(db.Model):
         logger.info("Processing product_id query for %s ...", product_id)
         return cls.query.filter(cls.product_id == product_id)
 
+    @classmethod
+    def find_applicable(cls, date, product_ids):
+        """Returns the ongoing Promotions of `product_ids` active on `date`
+
+        Args:
+            date (datetime): the moment the Promotions must be active at
+            product_ids (list): the ids of the products being priced
+        """
+        logger.info("Processing applicable query for %d products ...", len(product_ids))
+        return cls.find_active(date, list(product_ids)).filter(cls.ongoing.is_(True))
+
+    @classmethod
+    def find_by_product_ids(cls, product_ids):
+        """Return all Promotions applied to any of the products in `product_ids`
+
+        Args:
+            product_ids (list): the ids of the products whose promotions need to be fetched
+        """
+        logger.info("Processing product_id query for %d products ...", len(product_ids))
+        return cls.query.filter(cls.product_id.in_(product_ids))
+
+    @classmethod
+    def find_by_ids(cls, ids):
+        """Return all Promotions whose id is in `ids`
+
+        Args:
+            ids (list): the ids of the Promotions to fetch
+        """
+        logger.info("Processing lookup for %d ids ...", len(ids))
+        return cls.query.filter(cls.id.in_(ids))
+
+
+# "%m-%d-%Y %H:%M:%S" with an optional " %z" UTC offset such as +0000, -04:00 or Z
+DATETIME_PATTERN = re.compile(
+    r"\s*(\d{1,2})-(\d{1,2})-(\d{4})\s+(\d{1,2}):(\d{1,2}):(\d{1,2})"
+    r"(?:\s+(?:(Z)|([+-])(\d{2}):?(\d{2})(?::?(\d{2}))?))?\s*$"
+)
+
+
+@lru_cache(maxsize=None)
+def _utc_offset(sign, hours, minutes, seconds):
+    """Returns the timezone of a parsed UTC offset, shared by every date using it"""
+    offset = timedelta(hours=int(hours), minutes=int(minutes), seconds=int(seconds or 0))
+    if not offset:
+        return timezone.utc
+    return timezone(-offset if sign == "-" else offset)
 
+
+@lru_cache(maxsize=4096)
 def parse_datetime_optional_timezone(time_str):
-    """Parse datetime object from a string `time_str`"""
-    time_str = time_str.strip()
-    try:
-        return datetime.strptime(time_str, "%m-%d-%Y %H:%M:%S %z")
-    except:
-        date = datetime.strptime(time_str, "%m-%d-%Y %H:%M:%S")
-        date.replace(tzinfo=timezone.utc)
-        return date
+    """Parse datetime object from a string `time_str`
+
+    Reads "%m-%d-%Y %H:%M:%S" followed by an optional " %z" UTC offset in a
+    single pass. Dates without an offset are in UTC. The same strings, such
+    as the active_on of popular queries, come back again and again, so the
+    results are memoized.
+
+    Raises:
+        ValueError: if `time_str` is not a valid date in that format
+    """
+    match = DATETIME_PATTERN.match(time_str)
+    if match is None:
+        raise ValueError(
+            "time data {!r} does not match format '%m-%d-%Y %H:%M:%S %z'".format(time_str)
+        )
+    month, day, year, hour, minute, second, _, sign, hours, minutes, seconds = match.groups()
+    if sign is None:
+        tzinfo = timezone.utc
+    else:
+        tzinfo = _utc_offset(sign, hours, minutes, seconds)
+    return datetime(
+        int(year), int(month), int(day), int(hour), int(minute), int(second), tzinfo=tzinfo
+    )
@@ -0,0 +1,137 @@
+"""
+Query string parameters of the Promotions API
+
+Parses and validates the filters, paging and field selection of list
+requests. The functions take any mapping of parameters with a get()
+method, such as the request arguments of Flask or the query parameters of
+Starlette, so every entry point of the service validates them the same way.
+Invalid values raise DataValidationError.
+"""
+import base64
+import binascii
+
+from flask_restx import inputs
+
+from service.intervals import naive_utc
+from service.models import DataValidationError, Promotion, Type, parse_datetime_optional_timezone
+
+# query string parameters that filter the list of Promotions
+LIST_FILTERS = (
+    "id", "product_id", "name", "start_date", "active_on", "type", "ongoing",
+    "value_min", "value_max",
+)
+
+
+def parse_id_list(value, name, max_keys):
+    """Parses a comma separated list of ids such as "1,2,3" """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = [item for item in value.split(",") if item.strip()]
+    if not isinstance(value, list):
+        raise DataValidationError("Invalid {}: must be a list of integers".format(name))
+    if len(value) > max_keys:
+        raise DataValidationError(
+            "Too many {} values: at most {}".format(name, max_keys)
+        )
+    try:
+        if any(isinstance(item, (bool, float)) for item in value):
+            raise TypeError(name)
+        return [int(item) for item in value]
+    except (TypeError, ValueError):
+        raise DataValidationError("Invalid {}: must be a list of integers".format(name))
+
+
+def read_filter(args, name, parse):
+    """Parses the value of the `name` filter with `parse`, or returns None without one"""
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return parse(value)
+    except (KeyError, ValueError) as error:
+        raise DataValidationError("Invalid {}: {}".format(name, error))
+
+
+def read_date_filter(args, name):
+    """Parses the date of the `name` filter into the naive UTC the columns store"""
+    return naive_utc(read_filter(args, name, parse_datetime_optional_timezone))
+
+
+def list_filters(args, max_keys):
+    """Returns the list filters in `args` as keyword arguments of Promotion.matching()"""
+    return {
+        "ids": parse_id_list(args.get("id"), "id", max_keys) or None,
+        "product_ids": parse_id_list(args.get("product_id"), "product_id", max_keys) or None,
+        "name": args.get("name") or None,
+        "start_date": read_date_filter(args, "start_date"),
+        "active_on": read_date_filter(args, "active_on"),
+        "promotion_type": read_filter(args, "type", Type.__getitem__),
+        "ongoing": read_filter(args, "ongoing", inputs.boolean),
+        "value_min": read_filter(args, "value_min", float),
+        "value_max": read_filter(args, "value_max", float),
+    }
+
+
+def bulk_filters(args, max_keys):
+    """Returns the list filters of a bulk delete or invalidate
+
+    A bulk request acts on every match, so a parameter it does not know,
+    such as a misspelled filter, is rejected rather than ignored, and a
+    request without any filter must ask for every Promotion with all=true.
+    """
+    unknown = sorted(set(args.keys()) - set(LIST_FILTERS) - {"all"})
+    if unknown:
+        raise DataValidationError("Unknown parameters: {}".format(", ".join(unknown)))
+    filters = list_filters(args, max_keys)
+    if all(value is None for value in filters.values()):
+        if not read_filter(args, "all", inputs.boolean):
+            raise DataValidationError(
+                "A bulk request needs at least one filter, or all=true to act on every Promotion"
+            )
+    return filters
+
+
+def parse_fields(args):
+    """Returns the Promotion fields requested with `fields`, or all of them"""
+    value = args.get("fields")
+    if value is None:
+        return Promotion.ROW_FIELDS
+    fields = []
+    for field in value.split(","):
+        field = field.strip()
+        if field not in Promotion.ROW_FIELDS:
+            raise DataValidationError("Invalid fields: {!r} is not a Promotion field".format(field))
+        if field not in fields:
+            fields.append(field)
+    return tuple(fields)
+
+
+def parse_page_limit(args, max_size):
+    """Returns the requested page size capped at `max_size`, or None"""
+    limit = args.get("limit")
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise DataValidationError("Invalid limit: {}".format(limit))
+    if limit < 1:
+        raise DataValidationError("Invalid limit: must be at least 1")
+    return min(limit, max_size)
+
+
+def encode_cursor(promotion_id: int) -> str:
+    """Encodes the id of the last Promotion on a page as an opaque cursor"""
+    return base64.urlsafe_b64encode(str(promotion_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor made by encode_cursor back into a Promotion id"""
+    if not cursor:
+        return None
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(cursor + padding).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise DataValidationError("Invalid cursor: {}".format(cursor))
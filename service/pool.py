@@ -0,0 +1,133 @@
+"""
+Database connection pool statistics
+
+Counts what the connection pool of the process does, so its size and
+timeouts can be tuned to the instance: how long requests wait for a
+connection, how often they time out and how many connections are opened
+and closed along the way.
+
+Classes
+-------
+InstrumentedQueuePool - a QueuePool that times every checkout
+PoolStats - the counters of the pool, including a wait time histogram
+"""
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+# upper bounds in seconds of the buckets of the wait time histogram
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+
+class PoolStats:
+    """
+    Counters of a connection pool
+
+    Waits are recorded by InstrumentedQueuePool; connects, closes and
+    invalidations come from the pool events of the engines being watched.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Sets every counter back to zero"""
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.connects = 0
+            self.closes = 0
+            self.invalidations = 0
+            self.wait_sum = 0.0
+            self.wait_max = 0.0
+            self.wait_buckets = [0] * len(WAIT_BUCKETS)
+
+    def record_wait(self, seconds, timed_out=False):
+        """Records how long a checkout waited for a connection"""
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_sum += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            for index, bound in enumerate(WAIT_BUCKETS):
+                if seconds <= bound:
+                    self.wait_buckets[index] += 1
+                    break
+
+    def watch(self, engine):
+        """Counts the connections `engine` opens, closes and invalidates"""
+        if event.contains(engine, "connect", self._on_connect):
+            return
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "close", self._on_close)
+        event.listen(engine, "close_detached", self._on_close)
+        event.listen(engine, "invalidate", self._on_invalidate)
+
+    def stats(self, pool):
+        """Returns the counters together with the current state of `pool`"""
+        with self._lock:
+            waits = self.checkouts + self.timeouts
+            buckets = {}
+            total = 0
+            # cumulative counts, as in a Prometheus histogram
+            for bound, count in zip(WAIT_BUCKETS, self.wait_buckets):
+                total += count
+                buckets[str(bound)] = total
+            buckets["+Inf"] = waits
+            return {
+                "pool": type(pool).__name__,
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": max(pool.overflow(), 0),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "closes": self.closes,
+                "invalidations": self.invalidations,
+                "wait_seconds": {
+                    "count": waits,
+                    "sum": self.wait_sum,
+                    "max": self.wait_max,
+                    "buckets": buckets,
+                },
+            }
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_close(self, dbapi_connection, *args):
+        with self._lock:
+            self.closes += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that records how long each checkout waits in pool_stats
+
+    The wait includes opening a new connection when the pool has none idle.
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_stats.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record_wait(time.perf_counter() - start)
+        return connection
+
+
+# the pool statistics of the whole process
+pool_stats = PoolStats()
@@ -0,0 +1,89 @@
+"""
+Cart pricing engine
+
+Applies VALUE and PERCENTAGE Promotions to the lines of a cart. The engine
+is pure Python and does not touch the database: the caller fetches the
+applicable Promotions once and passes them in.
+
+Each product's Promotions are reduced to the largest VALUE and the largest
+PERCENTAGE discount up front, so pricing a cart costs O(lines + promotions)
+no matter how many Promotions a product has.
+
+Attributes:
+-----------
+CartLine - a (product_id, unit_price, qty) line of a cart
+PricedLine - a cart line with the best discount applied
+"""
+from collections import namedtuple
+
+from service.models import Type
+
+CartLine = namedtuple("CartLine", ["product_id", "unit_price", "qty"])
+
+PricedLine = namedtuple(
+    "PricedLine",
+    ["product_id", "unit_price", "qty", "promotion_id", "discount", "subtotal", "total"],
+)
+
+
+def best_offers(promotions):
+    """Reduces Promotions to the best offer of each type per product
+
+    Args:
+        promotions (iterable): the Promotions that apply to the cart
+
+    Returns:
+        dict: product_id -> ((value, promotion_id), (percentage, promotion_id)),
+        where a missing offer is (0.0, None)
+    """
+    offers = {}
+    for promotion in promotions:
+        best_value, best_percentage = offers.get(promotion.product_id, ((0.0, None), (0.0, None)))
+        if promotion.type == Type.VALUE and promotion.value > best_value[0]:
+            best_value = (promotion.value, promotion.id)
+        elif promotion.type == Type.PERCENTAGE and promotion.value > best_percentage[0]:
+            best_percentage = (min(promotion.value, 100.0), promotion.id)
+        else:
+            continue
+        offers[promotion.product_id] = (best_value, best_percentage)
+    return offers
+
+
+def price_lines(lines, promotions):
+    """Applies the best Promotion to every line of a cart
+
+    A VALUE Promotion takes `value` off the unit price and a PERCENTAGE
+    Promotion takes `value` percent off it; each line gets whichever saves
+    the most, and a unit price never drops below zero.
+
+    Args:
+        lines (list): the CartLines to price
+        promotions (iterable): the Promotions that apply to the cart
+
+    Returns:
+        list: a PricedLine for every CartLine, in order
+    """
+    offers = best_offers(promotions)
+    no_offer = ((0.0, None), (0.0, None))
+    priced = []
+    for line in lines:
+        (value, value_id), (percentage, percentage_id) = offers.get(line.product_id, no_offer)
+        value_discount = min(value, line.unit_price)
+        percentage_discount = line.unit_price * percentage / 100.0
+        if value_discount >= percentage_discount:
+            discount, promotion_id = value_discount, value_id
+        else:
+            discount, promotion_id = percentage_discount, percentage_id
+        subtotal = line.unit_price * line.qty
+        priced.append(
+            PricedLine(
+                line.product_id,
+                line.unit_price,
+                line.qty,
+                promotion_id if discount > 0 else None,
+                discount,
+                subtotal,
+                subtotal - discount * line.qty,
+            )
+        )
+    return priced
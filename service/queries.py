@@ -0,0 +1,147 @@
+"""
+SQL statement timing
+
+Counts the statements each request sends to the database and the time
+they take, and reports both in a Server-Timing header such as
+
+    Server-Timing: db;dur=3.1;desc="2 statements"
+
+Statements slower than a threshold are logged with their parameters and
+the plan EXPLAIN gives for them.
+
+Classes
+-------
+QueryLog - the engine event listeners and request hooks
+"""
+import logging
+import time
+
+from flask import g, has_request_context
+from sqlalchemy import event
+
+logger = logging.getLogger("flask.app")
+
+# statements whose plan is worth logging; EXPLAIN rejects the others
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+class RequestTiming:
+    """The statements run on behalf of one request and their total time"""
+
+    __slots__ = ("statements", "seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+    def server_timing(self):
+        """Returns the Server-Timing entry of the statements"""
+        return 'db;dur={:.1f};desc="{} statement{}"'.format(
+            self.seconds * 1000, self.statements, "" if self.statements == 1 else "s"
+        )
+
+
+class QueryLog:
+    """
+    Times every statement of the engines being watched
+
+    The time of a statement is added to the request running it, if any,
+    and the statement is logged when it takes `slow_seconds` or more.
+    """
+
+    def __init__(self):
+        self.slow_seconds = 0.0
+
+    def watch(self, engine, slow_seconds=None):
+        """Times the statements `engine` executes
+
+        Args:
+            slow_seconds (float): log statements taking this long, 0 never
+        """
+        if slow_seconds is not None:
+            self.slow_seconds = slow_seconds
+        if event.contains(engine, "before_cursor_execute", self._before_execute):
+            return
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def instrument(self, app):
+        """Reports the statements of every request of `app` in Server-Timing"""
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    @staticmethod
+    def start_request():
+        """Starts counting the statements of the request"""
+        g.db_timing = RequestTiming()
+
+    @staticmethod
+    def finish_request(response):
+        """Adds the statements counted so far to the Server-Timing header
+
+        Statements run while a streamed response is sent come after the
+        header, so they are not included.
+        """
+        timing = g.get("db_timing")
+        if timing is not None:
+            entries = response.headers.get("Server-Timing")
+            entry = timing.server_timing()
+            response.headers["Server-Timing"] = entry if not entries else entries + ", " + entry
+        return response
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context._query_start
+        if has_request_context():
+            timing = g.get("db_timing")
+            if timing is not None:
+                timing.statements += 1
+                timing.seconds += seconds
+        if 0 < self.slow_seconds <= seconds:
+            self._log_slow(conn, statement, parameters, executemany, seconds)
+
+    @staticmethod
+    def _log_slow(conn, statement, parameters, executemany, seconds):
+        """Logs a slow statement with its parameters and plan"""
+        plan = None
+        if not executemany and conn.dialect.name == "postgresql" and \
+                statement.lstrip().upper().startswith(EXPLAINABLE):
+            plan = explain(conn, statement, parameters)
+        logger.warning(
+            "Slow statement took %.1f ms: %s\nparameters: %r%s",
+            seconds * 1000,
+            statement,
+            parameters,
+            "" if plan is None else "\nplan:\n" + plan,
+        )
+
+
+def explain(conn, statement, parameters):
+    """Returns the plan of a statement that just ran on `conn`
+
+    The EXPLAIN runs in a savepoint of the same transaction, so it sees
+    the same rows and a failure cannot abort the transaction of the
+    request. Returns None when there is no plan.
+    """
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT explain_slow_statement")
+        try:
+            cursor.execute("EXPLAIN " + statement, parameters)
+            return "\n".join(row[0] for row in cursor.fetchall())
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_statement")
+            raise
+        finally:
+            cursor.execute("RELEASE SAVEPOINT explain_slow_statement")
+    except Exception as error:  # pylint: disable=broad-except
+        logger.debug("Cannot explain a slow statement: %s", error)
+        return None
+    finally:
+        cursor.close()
+
+
+# the statement timing of the whole process
+query_log = QueryLog()
@@ -0,0 +1,264 @@
+"""
+Read replica routing
+
+Sends the SELECTs of GET and HEAD requests to read replicas of the
+database, so reads do not compete with writes on the primary. Replicas
+are picked round-robin, one per request so that every statement of a
+request sees the same replica, and a replica that fails its health check
+is skipped until it passes again. The checks run on a background thread,
+so picking a replica never waits for the network. Without a healthy
+replica, reads go to the primary.
+
+A client that has just written reads its own writes: every successful
+write answers with a cookie that sends the reads of that client to the
+primary until the cookie expires, which should outlast the replication
+lag. The result cache must not undo this, so requests with the cookie
+skip it, and reads from a replica shortly after a write are not cached.
+
+Classes
+-------
+Replica - the engine of a replica and its health
+ReplicaPool - the replicas of the process and the request hooks
+RoutingSession - a Flask-SQLAlchemy session that reads from the chosen replica
+RoutingSQLAlchemy - a Flask-SQLAlchemy that creates RoutingSessions
+"""
+import logging
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import Select
+
+logger = logging.getLogger("flask.app")
+
+# the cookie that sends the reads of a client that wrote to the primary
+STICKY_COOKIE = "promotions_primary"
+READ_METHODS = ("GET", "HEAD")
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+# seconds a health check waits for a replica to accept a connection
+CONNECT_TIMEOUT = 2
+
+
+class Replica:
+    """The engine of a replica and the outcome of its last health check"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        # None until the first health check
+        self.healthy = None
+
+
+class ReplicaPool:
+    """
+    The read replicas of the process
+
+    Every `check_seconds` a background thread checks each replica with a
+    SELECT 1; a replica is only picked once a check has passed, and one
+    whose connection drops while in use is taken out at once until the
+    next check passes. The thread is started by the first pick in each
+    process, since threads do not survive the fork of a preloading server.
+    """
+
+    def __init__(self):
+        self.replicas = []
+        self.check_seconds = 5.0
+        self.sticky_seconds = 10
+        self._next = 0
+        self._lock = threading.Lock()
+        self._session = None
+        self._stop = threading.Event()
+        self._checker_pid = None
+        self._last_write = None
+
+    @property
+    def enabled(self):
+        """True when there are replicas to read from"""
+        return bool(self.replicas)
+
+    def configure(self, uris, engine_options=None, check_seconds=5.0, sticky_seconds=10):
+        """Replaces the replicas with one engine per URI in `uris`
+
+        Args:
+            uris (list): the database URIs of the replicas, none to read from the primary
+            engine_options (dict): options of every engine, as for the primary
+            check_seconds (float): seconds between the health checks of a replica
+            sticky_seconds (int): seconds a client reads from the primary after a write
+        """
+        options = dict(engine_options or {})
+        options.setdefault("connect_args", {"connect_timeout": CONNECT_TIMEOUT})
+        with self._lock:
+            # the checker of the old replicas stops, a new one starts on demand
+            self._stop.set()
+            self._stop = threading.Event()
+            self._checker_pid = None
+            for replica in self.replicas:
+                replica.engine.dispose()
+            self.replicas = [Replica(create_engine(uri, **options)) for uri in uris or ()]
+            self.check_seconds = check_seconds
+            self.sticky_seconds = sticky_seconds
+            self._next = 0
+            self._last_write = None
+        for replica in self.replicas:
+            event.listen(replica.engine, "handle_error", self._on_error(replica))
+        if self.replicas:
+            logger.info("Reading from %d replicas", len(self.replicas))
+
+    def choose(self):
+        """Returns the engine of the next healthy replica, None if there is none"""
+        if not self.replicas:
+            return None
+        with self._lock:
+            replicas = self.replicas
+            count = len(replicas)
+            start = self._next
+            self._next = (start + 1) % count
+            if self._checker_pid != os.getpid():
+                self._start_checker()
+        for offset in range(count):
+            replica = replicas[(start + offset) % count]
+            if replica.healthy:
+                return replica.engine
+        return None
+
+    def check_all(self):
+        """Runs the health check of every replica"""
+        for replica in list(self.replicas):
+            self.check(replica)
+
+    def check(self, replica):
+        """Runs the health check of `replica` and records its outcome"""
+        try:
+            with replica.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        except SQLAlchemyError as error:
+            self._mark(replica, False, error)
+        else:
+            self._mark(replica, True)
+
+    def stats(self):
+        """Returns the URL and health of every replica, without passwords"""
+        return [
+            {"url": repr(replica.engine.url), "healthy": replica.healthy}
+            for replica in self.replicas
+        ]
+
+    def _start_checker(self):
+        """Starts the thread that checks the replicas, called with the lock held"""
+        self._checker_pid = os.getpid()
+        thread = threading.Thread(
+            target=self._run_checks, args=(self._stop,), name="replica-checks", daemon=True
+        )
+        thread.start()
+
+    def _run_checks(self, stop):
+        while not stop.is_set():
+            self.check_all()
+            stop.wait(self.check_seconds)
+
+    def _on_error(self, replica):
+        def on_error(context):
+            if context.is_disconnect:
+                self._mark(replica, False, context.original_exception)
+        return on_error
+
+    @staticmethod
+    def _mark(replica, healthy, error=None):
+        if healthy and replica.healthy is False:
+            logger.info("Replica %r is back", replica.engine.url)
+        elif not healthy and replica.healthy is not False:
+            logger.warning("Replica %r is unavailable: %s", replica.engine.url, error)
+        replica.healthy = healthy
+
+    ######################################################################
+    # Result cache
+    ######################################################################
+
+    def cache_readable(self):
+        """False when the request must not be answered from the result cache
+
+        A client with the sticky cookie reads its own writes from the
+        primary, and a cached result may come from a replica that had not
+        seen them yet.
+        """
+        return not (has_request_context() and STICKY_COOKIE in request.cookies)
+
+    def cache_writable(self):
+        """False when the reads of the request may miss a recent write
+
+        Reads from a replica within `sticky_seconds` of the last write of
+        this process may lag behind it, and caching them would keep
+        serving the old data after the replica has caught up.
+        """
+        if read_replica() is None:
+            return True
+        last_write = self._last_write
+        return last_write is None or time.monotonic() - last_write >= self.sticky_seconds
+
+    ######################################################################
+    # Request hooks
+    ######################################################################
+
+    def instrument(self, app, session):
+        """Routes the reads of every request of `app` made through `session`"""
+        self._session = session
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.end_request)
+
+    def start_request(self):
+        """Picks the replica the reads of the request go to, if any"""
+        g.read_replica = None
+        if (
+            self.replicas
+            and request.method in READ_METHODS
+            and STICKY_COOKIE not in request.cookies
+        ):
+            g.read_replica = self.choose()
+
+    def finish_request(self, response):
+        """Sends the reads of a client that just wrote to the primary for a while"""
+        if self.replicas and request.method in WRITE_METHODS and response.status_code < 400:
+            self._last_write = time.monotonic()
+            response.set_cookie(
+                STICKY_COOKIE, "1", max_age=self.sticky_seconds, httponly=True, samesite="Lax"
+            )
+        return response
+
+    def end_request(self, _error=None):
+        """Ends the transaction of the replica so its connection goes back to the pool"""
+        if g.pop("read_replica", None) is not None:
+            self._session.rollback()
+
+
+def read_replica():
+    """Returns the engine the reads of the current request go to, None for the primary"""
+    if not has_request_context():
+        return None
+    return g.get("read_replica")
+
+
+class RoutingSession(SignallingSession):
+    """A session that runs the SELECTs of read requests on their replica"""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        """Returns the replica of the request for a SELECT, the primary otherwise"""
+        if isinstance(clause, Select) and not self._flushing:
+            replica = read_replica()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """A Flask-SQLAlchemy whose sessions read from replicas"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# the replicas shared by the whole process
+replicas = ReplicaPool()
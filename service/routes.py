@@ -4,22 +4,56 @@ Promotions Service
 Paths:
 ------
 GET /promotions - Returns a list all of the Promotions
+GET /promotions?limit={n}&after={cursor} - Returns one page of Promotions
+GET /promotions?product_id={id},{id}&id={id},{id} - Returns the Promotions with any of the ids
+GET /promotions?fields={field},{field} - Returns only the given fields of each Promotion
+GET /promotions?{filter}={value}&... - Returns the Promotions matching every filter
+POST /promotions/apply - Prices a cart with the best applicable Promotions
+POST /promotions/lookup - Returns the Promotions of many products and ids grouped by key
+GET /promotions with Accept: application/x-ndjson - Streams Promotions one per line
+GET /promotions/count?{filters} - Returns the number of Promotions matching the list filters
+HEAD /promotions?{filters} - Returns the number of matching Promotions in X-Total-Count
 GET /promotions/{id} - Returns the Promotion with a given id number
 POST /promotions - creates a new Promotion record in the database
+POST /promotions/bulk - creates many Promotion records in one transaction
 PUT /promotions/{id} - updates a Promotion record in the database
 DELETE /promotions/{id} - deletes a Promotion record in the database
+GET /stats/cache - Returns the hit, miss and eviction counters of the result cache
+GET /stats/pool - Returns the state, wait times and churn of the database connection pool
+GET /stats/replicas - Returns the health of the read replicas
+GET /metrics - Returns request latency, status and size metrics in the Prometheus text format
+DELETE /promotions?{filters}|all=true - deletes every Promotion matching the list filters
+PUT /promotions/{id}/invalidate - invalidates a Promotion
+PUT /promotions/invalidate?{filters}|all=true - invalidates every Promotion matching the list filters
 """
 
+import hashlib
+import json
+from datetime import datetime
+from urllib.parse import urlencode
 
-from flask import abort, jsonify, make_response, request, url_for
+from flask import Response, abort, jsonify, make_response, request, stream_with_context, url_for
 from flask_restx import Api, Resource, fields, reqparse, inputs
 from werkzeug.exceptions import NotFound
-
-from service.models import Promotion, Type, DataValidationError, DatabaseConnectionError
+from werkzeug.http import quote_etag
+
+from service import metrics, params
+from service.cache import LIST_TAG, product_tag, promotion_tag, result_cache
+from service.intervals import active_index, naive_utc
+from service.params import LIST_FILTERS, decode_cursor, encode_cursor
+from service.pool import pool_stats
+from service.pricing import CartLine, price_lines
+from service.replicas import replicas
+from service.serializers import encode_dict, encode_list, encode_row, row_encoder
+from service.models import (
+    Promotion, Type, DataValidationError, DatabaseConnectionError, db,
+    parse_datetime_optional_timezone
+)
 
 from . import app, status
 
 CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_NDJSON = "application/x-ndjson"
 
 ######################################################################
 # GET INDEX
@@ -38,6 +72,27 @@ def service():
     app.logger.info("Request for service page")
     return app.send_static_file("service.html")
 
+@app.route("/stats/cache")
+def cache_stats():
+    """Counters of the query result cache"""
+    return jsonify(result_cache.stats()), status.HTTP_200_OK
+
+@app.route("/stats/pool")
+def pool_stats_view():
+    """State and counters of the database connection pool"""
+    return jsonify(pool_stats.stats(db.engine.pool)), status.HTTP_200_OK
+
+@app.route("/stats/replicas")
+def replicas_view():
+    """Health of the read replicas"""
+    return jsonify(replicas.stats()), status.HTTP_200_OK
+
+@app.route("/metrics")
+def metrics_view():
+    """Request metrics in the Prometheus text exposition format"""
+    body, content_type = metrics.exposition()
+    return Response(body, status=status.HTTP_200_OK, content_type=content_type)
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
@@ -82,7 +137,29 @@ promotion_model = api.inherit(
 promotion_args = reqparse.RequestParser()
 promotion_args.add_argument('name', type=str, required=False, help='List Promotions by name')
 promotion_args.add_argument('start_date', type=str, required=False, help='List Promotions by start date')
-promotion_args.add_argument('product_id', type=str, required=False, help='List Promotions applied to product identified by product_id')
+promotion_args.add_argument('id', type=str, required=False, help='List Promotions by a comma separated list of ids')
+promotion_args.add_argument('product_id', type=str, required=False, help='List Promotions applied to products identified by a comma separated list of product_id')
+promotion_args.add_argument('active_on', type=str, required=False, help='List Promotions active on a date')
+promotion_args.add_argument('type', type=str, required=False, choices=Type._member_names_, help='List Promotions of a type')
+promotion_args.add_argument('ongoing', type=str, required=False, help='List Promotions that are ongoing (true) or not (false)')
+promotion_args.add_argument('value_min', type=float, required=False, help='List Promotions with at least this value')
+promotion_args.add_argument('value_max', type=float, required=False, help='List Promotions with at most this value')
+promotion_args.add_argument('limit', type=int, required=False, help='Maximum number of Promotions to return in one page')
+promotion_args.add_argument('after', type=str, required=False, help='Cursor from the next link of the previous page')
+promotion_args.add_argument('fields', type=str, required=False, help='Comma separated list of the fields to return for each Promotion')
+
+# query string arguments of counts: the list filters, without paging
+count_args = promotion_args.copy()
+for argument in ('limit', 'after', 'fields'):
+    count_args.remove_argument(argument)
+count_args.add_argument('estimate', type=str, required=False, help='Estimate large counts from the planner statistics (true) instead of counting')
+
+# query string arguments of bulk deletes and invalidations: the list
+# filters, or all=true to act on every Promotion
+bulk_args = promotion_args.copy()
+for argument in ('limit', 'after', 'fields'):
+    bulk_args.remove_argument(argument)
+bulk_args.add_argument('all', type=str, required=False, help='Act on every Promotion (true) when no filter is given')
 
 ######################################################################
 # Special Error Handlers
@@ -129,20 +206,44 @@ class PromotionResource(Resource):
     #------------------------------------------------------------------
     @api.doc('get_promotions')
     @api.response(404, 'Promotion not found')
-    @api.marshal_with(promotion_model)
+    @api.response(304, 'Promotion not modified')
+    @api.response(200, 'Success', promotion_model)
     def get(self, promotion_id):
         """
         Retrieve a single Promotion
 
-        This endpoint will return a Promotion based on its id
+        This endpoint will return a Promotion based on its id. The response
+        carries an ETag; send it back in If-None-Match to get a 304 Not
+        Modified without a body while the Promotion is unchanged.
         """
         app.logger.info("Request for promotion with id: %s", promotion_id)
-        promotion = Promotion.find(promotion_id)
-        if not promotion:
-            abort(status.HTTP_404_NOT_FOUND, 'Promotion not found.')
-
-        app.logger.info("Returning promotion: %s", promotion.name)
-        return promotion.serialize(), status.HTTP_200_OK
+        cache_key = "promotion:" + str(promotion_id)
+        generation = result_cache.generation
+        cached = get_cached(cache_key)
+        if cached is None:
+            etag = None
+            if not result_cache.enabled:
+                # check the version alone before reading and encoding the row
+                etag = promotion_etag(promotion_id)
+                if etag is not None and request.if_none_match.contains_weak(etag):
+                    return not_modified(etag)
+            row = find_promotion_row(promotion_id)
+            if not row:
+                abort(status.HTTP_404_NOT_FOUND, 'Promotion not found.')
+            result = encode_row(row)
+            cached = (result, etag or body_etag(result))
+            set_cached(cache_key, cached, [promotion_tag(row.id)], generation)
+        result, etag = cached
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
+        app.logger.info("Returning promotion with id: %s", promotion_id)
+        return Response(
+            result,
+            status=status.HTTP_200_OK,
+            mimetype=CONTENT_TYPE_JSON,
+            headers={"ETag": quote_etag(etag)},
+        )
 
     #------------------------------------------------------------------
     # DELETE A PROMOTION
@@ -217,6 +318,29 @@ class InvalidateResource(Resource):
         return promotion.serialize(), status.HTTP_200_OK
 
 
+######################################################################
+#  PATH: /promotions/invalidate
+######################################################################
+@api.route('/promotions/invalidate')
+class InvalidateCollection(Resource):
+    """Invalidate every Promotion matching the list filters"""
+    @api.doc('invalidate_promotion_list')
+    @api.expect(bulk_args, validate=True)
+    @api.response(400, 'No filter, or an unknown parameter, was given')
+    def put(self):
+        """
+        Invalidates Promotions in bulk
+
+        Takes the same filters as listing Promotions and sets ongoing to
+        False on all of the matches with a single UPDATE statement. At
+        least one filter, or all=true, is required.
+        """
+        app.logger.info("Request to invalidate promotions in bulk")
+        count = Promotion.invalidate_matching(find_bulk_targets())
+        app.logger.info("Invalidated %d promotions", count)
+        return {'count': count}, status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /promotions
 ######################################################################
@@ -228,29 +352,93 @@ class PromotionCollection(Resource):
     #------------------------------------------------------------------
     @api.doc('list_promotions')
     @api.expect(promotion_args, validate=True)
-    @api.marshal_list_with(promotion_model)
+    @api.response(200, 'Success', [promotion_model])
+    @api.produces([CONTENT_TYPE_JSON, CONTENT_TYPE_NDJSON])
     def get(self):
-        """Returns all of the promotions"""
+        """Returns all of the promotions
+
+        Pass `limit` to receive one page at a time. When more Promotions
+        remain, the response carries a `Link` header with rel="next" whose
+        `after` cursor continues from the last Promotion of this page.
+
+        Send `Accept: application/x-ndjson` to receive one Promotion per line,
+        streamed straight from the database cursor.
+
+        Pass `fields`, such as `fields=id,product_id,type,value`, to receive
+        only those fields of each Promotion; only their columns are read
+        from the database.
+        """
         app.logger.info("Request for promotion list")
-        promotions = []
-        product_id = request.args.get("product_id")
-        name = request.args.get("name")
-        start_date = request.args.get("start_date")
-        query_date = request.args.get("active_on")
-        if product_id:
-            promotions = Promotion.find_by_product_id(product_id)
-        elif name:
-            promotions = Promotion.find_by_name(name)
-        elif start_date:
-            promotions = Promotion.find_by_start_date(start_date)
-        elif query_date:
-            promotions = Promotion.find_active(query_date)
-        else:
-            promotions = Promotion.all()
+        limit = get_page_limit()
+        after = decode_cursor(request.args.get("after"))
+        fields = get_fields()
+        if limit is None and wants_ndjson():
+            # full exports stream from the database and are never cached
+            encode = row_encoder(fields)
+            rows = Promotion.project(
+                Promotion.paginate(find_promotions(), after), fields, batch_size=1000
+            )
+            return stream_ndjson(encode(row) for row in rows)
+
+        media_type = CONTENT_TYPE_NDJSON if wants_ndjson() else CONTENT_TYPE_JSON
+        cache_key = "list:{}:{}".format(media_type, normalized_query_string())
+        generation = result_cache.generation
+        cached = get_cached(cache_key)
+        if cached is None:
+            etag = None
+            if not result_cache.enabled and not index_answers():
+                # check the versions alone before reading and encoding the rows
+                etag = list_etag(cache_key, limit, after)
+                if request.if_none_match.contains_weak(etag):
+                    return not_modified(etag)
+            results, headers = list_promotions(limit, after, fields)
+            if media_type == CONTENT_TYPE_NDJSON:
+                body = "".join(result + "\n" for result in results)
+            else:
+                body = encode_list(results)
+            etag = etag or body_etag(body, headers.get("Link"))
+            cached = (body, dict(headers, ETag=quote_etag(etag)), etag, len(results))
+            set_cached(cache_key, cached, list_cache_tags(), generation)
+        body, headers, etag, count = cached
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
+        app.logger.info("Returning %d promotions", count)
+        return Response(body, status=status.HTTP_200_OK, mimetype=media_type, headers=headers)
 
-        results = [promotion.serialize() for promotion in promotions]
-        app.logger.info("Returning %d promotions", len(results))
-        return results, status.HTTP_200_OK
+    #------------------------------------------------------------------
+    # COUNT PROMOTIONS WITHOUT A BODY
+    #------------------------------------------------------------------
+    @api.doc('count_promotion_list_head')
+    @api.expect(count_args, validate=True)
+    @api.response(200, 'Success', headers={'X-Total-Count': 'The number of matching Promotions'})
+    def head(self):
+        """Counts promotions
+
+        Takes the same filters as listing Promotions and answers with the
+        number of matches in the X-Total-Count header and no body.
+        """
+        app.logger.info("Request for promotion count headers")
+        count, _ = count_promotions()
+        return Response(status=status.HTTP_200_OK, headers={"X-Total-Count": str(count)})
+
+    #------------------------------------------------------------------
+    # DELETE PROMOTIONS IN BULK
+    #------------------------------------------------------------------
+    @api.doc('delete_promotion_list')
+    @api.expect(bulk_args, validate=True)
+    @api.response(400, 'No filter, or an unknown parameter, was given')
+    def delete(self):
+        """Deletes promotions in bulk
+
+        Takes the same filters as listing Promotions and deletes all of the
+        matches with a single DELETE statement. At least one filter is
+        required; all=true deletes every Promotion.
+        """
+        app.logger.info("Request to delete promotions in bulk")
+        count = Promotion.delete_matching(find_bulk_targets())
+        app.logger.info("Deleted %d promotions", count)
+        return {'count': count}, status.HTTP_200_OK
 
     #------------------------------------------------------------------
     # ADD A NEW PROMOTION
@@ -275,6 +463,204 @@ class PromotionCollection(Resource):
         app.logger.info("Promotion with ID [%s] created.", promotion.id)
         return message, status.HTTP_201_CREATED, {"Location": location_url}
 
+######################################################################
+#  PATH: /promotions/count
+######################################################################
+count_model = api.model('Count', {
+    'count': fields.Integer(readOnly=True,
+                            description='The number of matching Promotions'),
+    'estimated': fields.Boolean(readOnly=True,
+                                description='Is the count an estimate from the planner statistics?'),
+})
+
+@api.route('/promotions/count')
+class CountResource(Resource):
+    """ Counts the Promotions matching the list filters """
+    @api.doc('count_promotions')
+    @api.expect(count_args, validate=True)
+    @api.marshal_with(count_model)
+    def get(self):
+        """Counts promotions
+
+        Takes the same filters as listing Promotions and returns how many
+        match with a single SELECT count(*). Pass `estimate=true` to accept
+        the planner's estimate instead when it expects at least
+        COUNT_ESTIMATE_MIN matches; `estimated` tells which one was used.
+        """
+        app.logger.info("Request for promotion count")
+        count, estimated = count_promotions()
+        app.logger.info("Counted %d promotions", count)
+        return (
+            {'count': count, 'estimated': estimated},
+            status.HTTP_200_OK,
+            {"X-Total-Count": str(count)},
+        )
+
+
+######################################################################
+#  PATH: /promotions/apply
+######################################################################
+cart_line_model = api.model('CartLine', {
+    'product_id': fields.Integer(required=True,
+                                 description='The product id of the line'),
+    'unit_price': fields.Float(required=True,
+                               description='The price of one unit of the product'),
+    'qty': fields.Integer(required=True,
+                          description='The number of units bought'),
+})
+
+cart_model = api.model('Cart', {
+    'timestamp': fields.String(required=False,
+                               description='The moment to price the cart at, defaults to now'),
+    'lines': fields.List(fields.Nested(cart_line_model), required=True,
+                         description='The lines of the cart'),
+})
+
+@api.route('/promotions/apply')
+class ApplyResource(Resource):
+    """ Prices a cart with the Promotions that apply to it """
+    @api.doc('apply_promotions')
+    @api.response(400, 'The posted data was not valid')
+    @api.expect(cart_model)
+    def post(self):
+        """Applies promotions to a cart
+
+        Fetches every ongoing Promotion active at `timestamp` for the
+        products in the cart with a single query, then gives each line the
+        VALUE or PERCENTAGE Promotion that takes the most off its price.
+        """
+        app.logger.info("Request to apply promotions to a cart")
+        check_content_type(CONTENT_TYPE_JSON)
+        data = api.payload
+        if not isinstance(data, dict):
+            raise DataValidationError("Invalid cart: body must be a JSON object")
+        lines = read_cart_lines(data.get("lines"))
+        timestamp = data.get("timestamp")
+        if timestamp is None:
+            timestamp = datetime.utcnow()
+        elif isinstance(timestamp, str):
+            try:
+                timestamp = naive_utc(parse_datetime_optional_timezone(timestamp))
+            except ValueError as error:
+                raise DataValidationError("Invalid timestamp: " + str(error))
+        else:
+            raise DataValidationError("Invalid type for string [timestamp]: " + str(type(timestamp)))
+
+        product_ids = {line.product_id for line in lines}
+        promotions = Promotion.find_applicable(timestamp, product_ids) if product_ids else []
+        priced = price_lines(lines, promotions)
+
+        subtotal = sum(line.subtotal for line in priced)
+        total = sum(line.total for line in priced)
+        app.logger.info("Priced a cart of %d lines", len(priced))
+        return {
+            'lines': [
+                {
+                    'product_id': line.product_id,
+                    'unit_price': line.unit_price,
+                    'qty': line.qty,
+                    'promotion_id': line.promotion_id,
+                    'discount': round(line.discount, 2),
+                    'subtotal': round(line.subtotal, 2),
+                    'total': round(line.total, 2),
+                }
+                for line in priced
+            ],
+            'subtotal': round(subtotal, 2),
+            'discount': round(subtotal - total, 2),
+            'total': round(total, 2),
+        }, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /promotions/lookup
+######################################################################
+lookup_model = api.model('Lookup', {
+    'product_ids': fields.List(fields.Integer, required=False,
+                               description='The product ids to fetch Promotions for'),
+    'ids': fields.List(fields.Integer, required=False,
+                       description='The ids of the Promotions to fetch'),
+})
+
+@api.route('/promotions/lookup')
+class LookupResource(Resource):
+    """ Fetches the Promotions of many products and ids at once """
+    @api.doc('lookup_promotions')
+    @api.response(400, 'The posted data was not valid')
+    @api.expect(lookup_model)
+    def post(self):
+        """Looks up promotions by product ids and promotion ids
+
+        Each list is resolved with a single query. The response groups the
+        Promotions by key: `product_ids` maps every requested product id to
+        its Promotions and `ids` maps every requested id to its Promotion,
+        or null when there is none.
+        """
+        app.logger.info("Request to look up promotions")
+        check_content_type(CONTENT_TYPE_JSON)
+        data = api.payload
+        if not isinstance(data, dict):
+            raise DataValidationError("Invalid lookup: body must be a JSON object")
+        product_ids = parse_id_list(data.get("product_ids"), "product_ids")
+        ids = parse_id_list(data.get("ids"), "ids")
+
+        by_product = {str(product_id): [] for product_id in product_ids}
+        if product_ids:
+            promotions = Promotion.paginate(Promotion.find_by_product_ids(product_ids))
+            for promotion in promotions:
+                by_product[str(promotion.product_id)].append(promotion.serialize())
+        by_id = {str(promotion_id): None for promotion_id in ids}
+        if ids:
+            for promotion in Promotion.find_by_ids(ids):
+                by_id[str(promotion.id)] = promotion.serialize()
+
+        app.logger.info(
+            "Looked up %d products and %d ids", len(product_ids), len(ids)
+        )
+        return {'product_ids': by_product, 'ids': by_id}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /promotions/bulk
+######################################################################
+@api.route('/promotions/bulk')
+class PromotionBulkResource(Resource):
+    """ Creates many Promotions at once """
+    @api.doc('bulk_create_promotions')
+    @api.response(400, 'The posted data was not valid')
+    @api.expect([create_model])
+    def post(self):
+        """Creates promotions in bulk
+
+        This endpoint takes a JSON array, or newline delimited JSON, of
+        Promotions. Every item is validated first; if any item is invalid
+        nothing is created and the errors are reported by item index.
+        Otherwise all of the Promotions are inserted in one transaction.
+        """
+        app.logger.info("Request to create promotions in bulk")
+        check_content_type(CONTENT_TYPE_JSON, CONTENT_TYPE_NDJSON)
+        items = read_bulk_payload(app.config["BULK_MAX_ITEMS"])
+        promotions = []
+        errors = []
+        for index, item in enumerate(items):
+            try:
+                promotions.append(Promotion().deserialize(item))
+            except DataValidationError as error:
+                errors.append({'index': index, 'message': str(error)})
+        if errors:
+            app.logger.error("Rejected bulk create with %d invalid items", len(errors))
+            return {
+                'status_code': status.HTTP_400_BAD_REQUEST,
+                'error': 'Bad Request',
+                'message': '{} of {} promotions are invalid'.format(len(errors), len(items)),
+                'errors': errors,
+            }, status.HTTP_400_BAD_REQUEST
+
+        ids = Promotion.bulk_create(promotions)
+        app.logger.info("Created %d promotions in bulk", len(ids))
+        return {'count': len(ids), 'ids': ids}, status.HTTP_201_CREATED
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
@@ -284,19 +670,284 @@ def abort(error_code: int, message: str):
     app.logger.error(message)
     api.abort(error_code, message)
 
-def check_content_type(media_type):
+def check_content_type(*media_types):
     """Checks that the media type is correct"""
     content_type = request.headers.get("Content-Type")
-    if content_type and content_type == media_type:
+    if content_type and content_type in media_types:
         return
     app.logger.error("Invalid Content-Type: %s", content_type)
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-        "Content-Type must be {}".format(media_type),
+        "Content-Type must be {}".format(" or ".join(media_types)),
+    )
+
+def read_bulk_payload(max_items):
+    """Reads at most `max_items` items from a JSON array or NDJSON request body"""
+    too_many = "Too many promotions: at most {} per request".format(max_items)
+    if request.headers.get("Content-Type") == CONTENT_TYPE_NDJSON:
+        items = []
+        for number, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            if not line.strip():
+                continue
+            if len(items) == max_items:
+                raise DataValidationError(too_many)
+            try:
+                items.append(json.loads(line))
+            except ValueError as error:
+                raise DataValidationError("Invalid JSON on line {}: {}".format(number, error))
+        return items
+    items = api.payload
+    if not isinstance(items, list):
+        raise DataValidationError("Invalid bulk request: body must be a JSON array")
+    if len(items) > max_items:
+        raise DataValidationError(too_many)
+    return items
+
+def body_etag(body, link=None):
+    """Returns a strong ETag for the response `body` and its `link` header
+
+    The ETag is a hash of the exact text sent, so it changes exactly when
+    the response does, wherever the body came from. It is used for bodies
+    kept in the result cache, which stores it with them, and for bodies
+    from the interval index, which has no versions.
+    """
+    data = body if link is None else "{}\n{}".format(link, body)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+def promotion_etag(promotion_id):
+    """Returns a strong ETag for the current version of a Promotion, None without one
+
+    Only the version column is read, so a 304 costs neither the row nor
+    its encoding. The version is read before the row, so the body sent
+    with this ETag is never older than it.
+    """
+    try:
+        promotion_id = int(promotion_id)
+    except ValueError:
+        return None
+    version = Promotion.version_of(promotion_id)
+    if version is None:
+        return None
+    return hashlib.sha1("{}:{}".format(promotion_id, version).encode()).hexdigest()
+
+def list_etag(cache_key, limit, after):
+    """Returns a strong ETag for the current versions of a page of Promotions
+
+    The ETag covers the rows the page reads, including the extra row that
+    decides its Link header, through their number and the sum of their
+    versions, which only the id and version columns are read for.
+    """
+    fetch = None if limit is None else limit + 1
+    count, total = Promotion.versions(Promotion.paginate(find_promotions(), after, fetch))
+    return hashlib.sha1("{}:{}:{}".format(cache_key, count, total).encode()).hexdigest()
+
+def not_modified(etag):
+    """Returns a 304 Not Modified response for `etag`"""
+    app.logger.info("Promotions not modified")
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": quote_etag(etag)})
+
+def find_promotion_row(promotion_id):
+    """Returns the row of the Promotion with `promotion_id`, or None"""
+    try:
+        promotion_id = int(promotion_id)
+    except ValueError:
+        return None
+    return Promotion.as_rows(Promotion.find_by_ids([promotion_id])).first()
+
+def list_promotions(limit, after, fields):
+    """Returns the JSON text of a page of Promotions and the headers to send with it"""
+    # fetch one extra row to find out if there is a next page
+    fetch = None if limit is None else limit + 1
+    results = find_active_in_index(after, fetch)
+    if results is None:
+        # the id is always selected, after the requested fields, for the cursor
+        columns = fields if "id" in fields else fields + ("id",)
+        encode = row_encoder(fields)
+        rows = Promotion.project(Promotion.paginate(find_promotions(), after, fetch), columns)
+        results = [(row.id, encode(row)) for row in rows]
+    elif fields == Promotion.ROW_FIELDS:
+        results = [(result["id"], encode_dict(result)) for result in results]
+    else:
+        results = [
+            (result["id"], encode_dict({field: result[field] for field in fields}))
+            for result in results
+        ]
+    headers = {}
+    if limit is not None and len(results) > limit:
+        results = results[:limit]
+        headers["Link"] = '<{}>; rel="next"'.format(
+            next_page_url(encode_cursor(results[-1][0]), limit)
+        )
+    return [text for _, text in results], headers
+
+def count_promotions():
+    """Counts the Promotions selected by the list query string
+
+    Returns:
+        tuple: the count, and True if it is the planner's estimate
+    """
+    estimate = read_filter("estimate", inputs.boolean) or False
+    cache_key = "count:{}".format(normalized_query_string())
+    generation = result_cache.generation
+    cached = get_cached(cache_key)
+    if cached is None:
+        query = find_promotions()
+        count = Promotion.estimate_count(query) if estimate else None
+        if count is not None and count >= app.config["COUNT_ESTIMATE_MIN"]:
+            cached = (count, True)
+        else:
+            cached = (Promotion.count(query), False)
+        set_cached(cache_key, cached, list_cache_tags(), generation)
+    return cached
+
+def get_cached(key):
+    """Returns the result cached under `key`, None to read it from the database"""
+    if not replicas.cache_readable():
+        return None
+    return result_cache.get(key)
+
+def set_cached(key, value, tags, generation):
+    """Caches the result `value` of the request unless its reads may be stale"""
+    if replicas.cache_writable():
+        result_cache.set(key, value, tags, generation)
+
+def get_fields():
+    """Returns the Promotion fields requested with `fields`, or all of them"""
+    return params.parse_fields(request.args)
+
+def normalized_query_string():
+    """Returns the query string with its parameters in a canonical order"""
+    return urlencode(sorted(request.args.items(multi=True)))
+
+def list_cache_tags():
+    """Returns the cache tags of the Promotions the list query string selects"""
+    ids = parse_id_list(request.args.get("id"), "id")
+    if ids:
+        return [promotion_tag(promotion_id) for promotion_id in ids]
+    product_ids = parse_id_list(request.args.get("product_id"), "product_id")
+    if product_ids:
+        return [product_tag(product_id) for product_id in product_ids]
+    return [LIST_TAG]
+
+def find_promotions():
+    """Returns the Promotion query selected by the list query string
+
+    Every filter in the query string applies; a Promotion must match all
+    of them.
+    """
+    filters = params.list_filters(request.args, app.config["LOOKUP_MAX_KEYS"])
+    return Promotion.find_matching(**filters)
+
+def find_bulk_targets():
+    """Returns the Promotion query of a bulk delete or invalidate
+
+    Unlike find_promotions(), unknown parameters and a query string
+    without filters are rejected unless all=true is given.
+    """
+    filters = params.bulk_filters(request.args, app.config["LOOKUP_MAX_KEYS"])
+    return Promotion.find_matching(**filters)
+
+def read_filter(name, parse):
+    """Parses the value of the `name` filter with `parse`, or returns None without one"""
+    return params.read_filter(request.args, name, parse)
+
+def read_cart_lines(items):
+    """Validates the lines of a cart and returns them as CartLines"""
+    if not isinstance(items, list):
+        raise DataValidationError("Invalid cart: lines must be a list")
+    lines = []
+    for index, item in enumerate(items):
+        try:
+            product_id, unit_price, qty = item["product_id"], item["unit_price"], item["qty"]
+        except (KeyError, TypeError):
+            raise DataValidationError(
+                "Invalid cart line {}: needs product_id, unit_price and qty".format(index)
+            )
+        if not isinstance(product_id, int) or isinstance(product_id, bool):
+            raise DataValidationError("Invalid cart line {}: bad product_id".format(index))
+        if not isinstance(unit_price, (int, float)) or isinstance(unit_price, bool) or unit_price < 0:
+            raise DataValidationError("Invalid cart line {}: bad unit_price".format(index))
+        if not isinstance(qty, int) or isinstance(qty, bool) or qty < 1:
+            raise DataValidationError("Invalid cart line {}: bad qty".format(index))
+        lines.append(CartLine(product_id, float(unit_price), qty))
+    return lines
+
+def parse_id_list(value, name):
+    """Parses a comma separated list of ids such as "1,2,3" """
+    return params.parse_id_list(value, name, app.config["LOOKUP_MAX_KEYS"])
+
+def index_answers():
+    """Checks if the list query string is answered from the interval index"""
+    if not active_index.enabled or not request.args.get("active_on"):
+        return False
+    return not any(
+        request.args.get(name) for name in LIST_FILTERS if name not in ("active_on", "product_id")
+    )
+
+def find_active_in_index(after, fetch):
+    """Answers an active_on lookup from the in-process interval index
+
+    Returns:
+        list: the serialized page of Promotions, or None when the index is
+        disabled or the query string asks for more than active_on and an
+        optional product_id
+    """
+    if not index_answers():
+        return None
+    query_date = request.args.get("active_on")
+    product_id = request.args.get("product_id")
+    try:
+        product_id = int(product_id) if product_id else None
+    except ValueError:
+        return None
+    try:
+        date = parse_datetime_optional_timezone(query_date)
+    except ValueError as error:
+        raise DataValidationError("Invalid active_on: " + str(error))
+    results = active_index.active_on(date, product_id)
+    if after is not None:
+        results = [result for result in results if result["id"] > after]
+    return results if fetch is None else results[:fetch]
+
+def wants_ndjson():
+    """Checks if the client asked for newline delimited JSON"""
+    best = request.accept_mimetypes.best_match([CONTENT_TYPE_JSON, CONTENT_TYPE_NDJSON])
+    return best == CONTENT_TYPE_NDJSON
+
+def stream_ndjson(results, headers=None):
+    """Streams the JSON text of Promotions to the client one per line"""
+    def generate():
+        count = 0
+        for result in results:
+            count += 1
+            yield result + "\n"
+        app.logger.info("Streamed %d promotions", count)
+
+    return Response(
+        stream_with_context(generate()),
+        status=status.HTTP_200_OK,
+        mimetype=CONTENT_TYPE_NDJSON,
+        headers=headers,
     )
 
+def get_page_limit():
+    """Returns the requested page size capped at PAGE_SIZE_MAX, or None"""
+    return params.parse_page_limit(request.args, app.config["PAGE_SIZE_MAX"])
+
+def next_page_url(cursor: str, limit: int) -> str:
+    """Builds the url of the next page keeping the current filters"""
+    args = request.args.to_dict()
+    args.update({"after": cursor, "limit": limit})
+    return api.url_for(PromotionCollection, _external=True, **args)
+
 
 def init_db():
     """Initializes the SQLAlchemy app"""
     global app
     Promotion.init_db(app)
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Creates the database tables and indexes"""
+    Promotion.create_schema()
@@ -0,0 +1,91 @@
+"""
+Test cases for the query result cache
+
+"""
+import unittest
+
+from service.cache import LRUBackend, NullBackend, ResultCache
+
+
+class FakeClock:
+    """A clock the tests move by hand"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  R E S U L T   C A C H E   T E S T   C A S E S
+######################################################################
+class TestResultCache(unittest.TestCase):
+    """Test Cases for ResultCache"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResultCache(LRUBackend(max_size=2, ttl=10, clock=self.clock))
+
+    def test_hit_and_miss(self):
+        """Count hits and misses"""
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", [1], ["list"])
+        self.assertEqual(self.cache.get("a"), [1])
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+        self.assertTrue(self.cache.enabled)
+
+    def test_lru_eviction(self):
+        """Evict the least recently used entry when full"""
+        self.cache.set("a", 1, [])
+        self.cache.set("b", 2, [])
+        self.cache.get("a")
+        self.cache.set("c", 3, [])
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("c"), 3)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_ttl_expiry(self):
+        """Expire entries after the TTL"""
+        self.cache.set("a", 1, [])
+        self.clock.now = 9.9
+        self.assertEqual(self.cache.get("a"), 1)
+        self.clock.now = 10.0
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_invalidate_tags(self):
+        """Evict exactly the entries filed under a tag"""
+        self.cache.set("a", 1, ["product:1", "list"])
+        self.cache.set("b", 2, ["product:2"])
+        self.cache.invalidate("product:1")
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("b"), 2)
+        self.cache.invalidate("list", "missing")
+        self.assertEqual(self.cache.stats()["invalidations"], 1)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.stats()["invalidations"], 2)
+
+    def test_skip_stale_results(self):
+        """Do not cache a result built before an invalidation"""
+        generation = self.cache.generation
+        self.cache.invalidate("list")
+        self.cache.set("a", 1, ["list"], generation)
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", 1, ["list"], self.cache.generation)
+        self.assertEqual(self.cache.get("a"), 1)
+
+    def test_null_backend(self):
+        """Store nothing when caching is disabled"""
+        cache = ResultCache()
+        self.assertFalse(cache.enabled)
+        cache.set("a", 1, ["list"])
+        self.assertIsNone(cache.get("a"))
+        cache.invalidate("list")
+        cache.clear()
+        self.assertEqual(cache.stats()["backend"], NullBackend.__name__)
@@ -0,0 +1,65 @@
+"""
+Test cases for the gunicorn settings
+
+Test cases can be run with:
+  nosetests -v --with-spec --spec-color
+"""
+import importlib.util
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+CONF_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py")
+
+
+def load_conf(**env):
+    """Loads gunicorn.conf.py with `env` added to the environment"""
+    spec = importlib.util.spec_from_file_location("gunicorn_conf", CONF_PATH)
+    conf = importlib.util.module_from_spec(spec)
+    # the settings read the environment when they are loaded
+    with patch.dict(os.environ, env):
+        spec.loader.exec_module(conf)
+    return conf
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestGunicornConf(TestCase):
+    """gunicorn Settings Tests"""
+
+    def test_parse_size(self):
+        """Parse memory sizes as Cloud Foundry and cgroups give them"""
+        conf = load_conf()
+        self.assertEqual(conf.parse_size("256M"), 256 * 1024 ** 2)
+        self.assertEqual(conf.parse_size("1g"), 1024 ** 3)
+        self.assertEqual(conf.parse_size("512kb"), 512 * 1024)
+        self.assertEqual(conf.parse_size("268435456"), 268435456)
+        self.assertRaises(ValueError, conf.parse_size, "lots")
+
+    def test_workers_fit_in_memory(self):
+        """Run no more workers than fit in the memory limit"""
+        with patch("multiprocessing.cpu_count", return_value=16):
+            conf = load_conf(MEMORY_LIMIT="256M", WEB_CONCURRENCY="")
+            # (256 - 60) // 40
+            self.assertEqual(conf.workers, 4)
+            conf = load_conf(MEMORY_LIMIT="64M", WEB_CONCURRENCY="")
+            self.assertEqual(conf.workers, 1)
+        with patch("multiprocessing.cpu_count", return_value=2):
+            conf = load_conf(MEMORY_LIMIT="4G", WEB_CONCURRENCY="")
+            self.assertEqual(conf.workers, 5)
+        conf = load_conf(MEMORY_LIMIT="256M", WEB_CONCURRENCY="7")
+        self.assertEqual(conf.workers, 7)
+
+    def test_worker_classes(self):
+        """Give threads to gthread workers only"""
+        conf = load_conf(GUNICORN_WORKER_CLASS="gthread", GUNICORN_THREADS="8")
+        self.assertEqual((conf.worker_class, conf.threads), ("gthread", 8))
+        conf = load_conf(GUNICORN_WORKER_CLASS="sync", GUNICORN_THREADS="8")
+        self.assertEqual((conf.worker_class, conf.threads), ("sync", 1))
+        conf = load_conf(GUNICORN_MAX_REQUESTS="500")
+        self.assertEqual((conf.max_requests, conf.max_requests_jitter), (500, 50))
+        self.assertTrue(conf.preload_app)
+        # gevent workers load the app after monkey-patching
+        conf = load_conf(GUNICORN_WORKER_CLASS="gevent", GUNICORN_PRELOAD="true")
+        self.assertFalse(conf.preload_app)
@@ -0,0 +1,170 @@
+"""
+Test cases for the in-memory interval index
+
+"""
+import random
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from service.intervals import ActivePromotionIndex, IntervalIndex, naive_utc
+
+from .factories import PromotionFactory
+
+
+######################################################################
+#  I N T E R V A L   I N D E X   T E S T   C A S E S
+######################################################################
+class TestIntervalIndex(unittest.TestCase):
+    """Test Cases for IntervalIndex"""
+
+    def test_overlapping(self):
+        """Find the intervals containing a point"""
+        index = IntervalIndex()
+        index.load([(1, 5, "a"), (4, 8, "b"), (9, 9, "c")])
+        self.assertEqual(sorted(index.overlapping(4)), ["a", "b"])
+        self.assertEqual(sorted(index.overlapping(5)), ["a", "b"])
+        self.assertEqual(index.overlapping(9), ["c"])
+        self.assertEqual(index.overlapping(0), [])
+        self.assertEqual(len(index), 3)
+
+    def test_add_and_remove(self):
+        """Add, replace and remove intervals after the tree is built"""
+        index = IntervalIndex()
+        index.load([(1, 5, "a"), (4, 8, "b")])
+        index.add("c", 2, 3)
+        index.add("a", 6, 7)
+        index.remove("b")
+        index.remove("missing")
+        self.assertEqual(index.overlapping(2), ["c"])
+        self.assertEqual(index.overlapping(6), ["a"])
+        self.assertEqual(len(index), 2)
+
+    def test_matches_brute_force(self):
+        """Agree with a linear scan through random updates and rebuilds"""
+        rng = random.Random(42)
+        index = IntervalIndex(rebuild_threshold=8)
+        intervals = {}
+        for key in range(300):
+            start = rng.randint(0, 1000)
+            end = start + rng.randint(0, 200)
+            if rng.random() < 0.2 and intervals:
+                victim = rng.choice(list(intervals))
+                del intervals[victim]
+                index.remove(victim)
+            intervals[key] = (start, end)
+            index.add(key, start, end)
+            point = rng.randint(0, 1200)
+            expected = sorted(k for k, (s, e) in intervals.items() if s <= point <= e)
+            self.assertEqual(sorted(index.overlapping(point)), expected)
+
+
+######################################################################
+#  A C T I V E   P R O M O T I O N   I N D E X   T E S T   C A S E S
+######################################################################
+class TestActivePromotionIndex(unittest.TestCase):
+    """Test Cases for ActivePromotionIndex"""
+
+    def setUp(self):
+        self.promotions = PromotionFactory.build_batch(20)
+        self.index = ActivePromotionIndex()
+        self.index.enable(lambda: self.promotions)
+
+    def _expected(self, date, product_id=None):
+        date = naive_utc(date)
+        return [
+            promotion.id
+            for promotion in self.promotions
+            if naive_utc(promotion.start_date) <= date
+            and (promotion.end_date is None or naive_utc(promotion.end_date) >= date)
+            and product_id in (None, promotion.product_id)
+        ]
+
+    def test_active_on(self):
+        """Find the Promotions active on a date"""
+        date = datetime(2022, 1, 21, 12, tzinfo=timezone.utc)
+        results = self.index.active_on(date)
+        self.assertEqual([r["id"] for r in results], self._expected(date))
+        self.assertEqual(results[0], self.promotions[0].serialize())
+
+    def test_active_on_for_product(self):
+        """Find the Promotions active on a date for one product"""
+        promotion = self.promotions[3]
+        date = promotion.start_date + timedelta(seconds=1)
+        results = self.index.active_on(date, promotion.product_id)
+        self.assertEqual([r["id"] for r in results], [promotion.id])
+        self.assertEqual(self.index.active_on(date, 10000), [])
+
+    def test_open_ended(self):
+        """Promotions without an end date stay active"""
+        promotion = self.promotions[0]
+        promotion.end_date = None
+        self.index.add(promotion)
+        date = datetime(2030, 1, 1)
+        self.assertEqual([r["id"] for r in self.index.active_on(date)], [promotion.id])
+
+    def test_incremental_updates(self):
+        """Track added, updated and removed Promotions"""
+        date = datetime(2022, 1, 21, 12)
+        promotion = self.promotions[5]
+        promotion.start_date = datetime(2023, 1, 1)
+        promotion.end_date = datetime(2023, 2, 1)
+        self.index.add(promotion)
+        self.assertNotIn(promotion.id, [r["id"] for r in self.index.active_on(date)])
+        self.index.remove(self.promotions[6].id)
+        del self.promotions[6]
+        self.assertEqual([r["id"] for r in self.index.active_on(date)], self._expected(date))
+
+    def test_stale_and_disabled(self):
+        """Reload when stale and ignore writes when disabled"""
+        self.assertEqual(self.index.active_on(datetime(2030, 6, 1)), [])
+        self.promotions.append(PromotionFactory(start_date=datetime(2030, 1, 1), end_date=None))
+        self.assertEqual(self.index.active_on(datetime(2030, 6, 1)), [])
+        self.index.mark_stale()
+        self.assertEqual(len(self.index.active_on(datetime(2030, 6, 1))), 1)
+        self.index.disable()
+        self.index.add(self.promotions[0])
+        self.assertFalse(self.index.enabled)
+
+    def test_lazy_load(self):
+        """Load the index on the first lookup after it is enabled"""
+        loads = []
+        index = ActivePromotionIndex()
+        index.enable(lambda: loads.append(1) or self.promotions)
+        self.assertEqual(loads, [])
+        index.active_on(datetime(2022, 1, 21, 12))
+        index.active_on(datetime(2022, 1, 22, 12))
+        self.assertEqual(loads, [1])
+
+    def test_reload_without_lock(self):
+        """Answer lookups and take writes while a reload reads the database"""
+        date = datetime(2030, 6, 1)
+        loads = []
+        loading, release = threading.Event(), threading.Event()
+
+        def loader():
+            loads.append(1)
+            if len(loads) > 1:
+                # every load after the first one is slow
+                loading.set()
+                release.wait(5)
+            return list(self.promotions)
+
+        self.index.enable(loader)
+        self.assertEqual(self.index.active_on(date), [])
+        self.index.mark_stale()
+        reload = threading.Thread(target=self.index.active_on, args=(date,))
+        reload.start()
+        self.assertTrue(loading.wait(5))
+        # lookups answer from the old contents instead of waiting
+        self.assertEqual(self.index.active_on(date), [])
+        # a write made during the load survives it
+        promotion = PromotionFactory(start_date=datetime(2030, 1, 1), end_date=None)
+        self.index.add(promotion)
+        self.assertEqual([r["id"] for r in self.index.active_on(date)], [promotion.id])
+        self.assertTrue(reload.is_alive())
+        release.set()
+        reload.join(5)
+        self.assertFalse(reload.is_alive())
+        self.assertEqual(len(loads), 2)
+        self.assertEqual([r["id"] for r in self.index.active_on(date)], [promotion.id])
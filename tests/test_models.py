@@ -5,10 +5,15 @@ Test cases for Promotion Model
 import logging
 import os
 import unittest
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import event, inspect, text
 
 from service import app
-from service.models import DataValidationError, Promotion, Type, db
+from service.intervals import naive_utc
+from service.models import (
+    DataValidationError, Promotion, Type, db, parse_datetime_optional_timezone
+)
 from werkzeug.exceptions import NotFound
 
 from .factories import PromotionFactory
@@ -32,6 +37,7 @@ class TestPromotion(unittest.TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
         Promotion.init_db(app)
+        Promotion.create_schema()
 
     @classmethod
     def tearDownClass(cls):
@@ -203,11 +209,11 @@ class TestPromotion(unittest.TestCase):
         self.assertEqual(promotion.name, example.name)
         self.assertEqual(
             promotion.start_date,
-            datetime.strptime(data["start_date"], "%m-%d-%Y %H:%M:%S %z"),
+            naive_utc(datetime.strptime(data["start_date"], "%m-%d-%Y %H:%M:%S %z")),
         )
         self.assertEqual(
             promotion.end_date,
-            datetime.strptime(data["end_date"], "%m-%d-%Y %H:%M:%S %z"),
+            naive_utc(datetime.strptime(data["end_date"], "%m-%d-%Y %H:%M:%S %z")),
         )
         self.assertEqual(promotion.type, example.type)
         self.assertEqual(promotion.value, example.value)
@@ -227,13 +233,41 @@ class TestPromotion(unittest.TestCase):
         self.assertEqual(promotion.name, example.name)
         self.assertEqual(
             promotion.start_date,
-            datetime.strptime(data["start_date"], "%m-%d-%Y %H:%M:%S %z"),
+            naive_utc(datetime.strptime(data["start_date"], "%m-%d-%Y %H:%M:%S %z")),
         )
         self.assertEqual(promotion.type, example.type)
         self.assertEqual(promotion.value, example.value)
         self.assertEqual(promotion.ongoing, example.ongoing)
         self.assertEqual(promotion.product_id, example.product_id)
 
+    def test_store_dates_in_utc(self):
+        """Store dates as naive UTC whatever the TimeZone of the session"""
+        def set_time_zone(connection, branch):
+            if not branch:
+                connection.exec_driver_sql("SET TIME ZONE 'America/New_York'")
+
+        db.session.remove()
+        event.listen(db.engine, "engine_connect", set_time_zone)
+        self.addCleanup(db.engine.dispose)
+        self.addCleanup(event.remove, db.engine, "engine_connect", set_time_zone)
+        data = PromotionFactory().serialize()
+        data["start_date"] = "01-01-2022 00:00:00"
+        data["end_date"] = "01-31-2022 00:00:00 +0100"
+        promotion = Promotion().deserialize(data)
+        promotion.create()
+        self.assertEqual(db.session.execute(text("SHOW TimeZone")).scalar(), "America/New_York")
+        row = db.session.execute(
+            text("SELECT start_date::text, end_date::text FROM promotion WHERE id = :id"),
+            {"id": promotion.id},
+        ).one()
+        self.assertEqual(tuple(row), ("2022-01-01 00:00:00", "2022-01-30 23:00:00"))
+        # filters with and without an offset find it the same way
+        start = datetime(2022, 1, 1, 1, tzinfo=timezone(timedelta(hours=1)))
+        self.assertEqual(Promotion.find_by_start_date(start).count(), 1)
+        self.assertEqual(Promotion.find_by_start_date("01-01-2022 00:00:00").count(), 1)
+        self.assertEqual(Promotion.find_active("01-30-2022 23:30:00 +0000").count(), 0)
+        self.assertEqual(Promotion.find_active("01-30-2022 23:30:00 +0100").count(), 1)
+
     def test_deserialize_bad_data(self):
         """Test deserialization of bad data"""
         data = "this is not a dictionary"
@@ -330,6 +364,28 @@ class TestPromotion(unittest.TestCase):
         promotion = Promotion()
         self.assertRaises(DataValidationError, promotion.deserialize, data)
 
+    def test_parse_datetime(self):
+        """Parse dates with and without a UTC offset"""
+        parse = parse_datetime_optional_timezone
+        for text in (
+            "01-02-2022 03:04:05 +0000",
+            "12-31-2022 23:59:59 -0400",
+            "1-2-2022 3:04:05 +0530",
+            " 01-02-2022 03:04:05 +05:30 ",
+            "01-02-2022 03:04:05 -000001",
+            "01-02-2022 03:04:05 Z",
+        ):
+            self.assertEqual(parse(text), datetime.strptime(text.strip(), "%m-%d-%Y %H:%M:%S %z"))
+        # dates without an offset are in UTC
+        date = parse("01-02-2022 03:04:05 ")
+        self.assertEqual(date, datetime(2022, 1, 2, 3, 4, 5, tzinfo=timezone.utc))
+        self.assertEqual(date.utcoffset(), timedelta(0))
+        # repeated strings are answered from the cache
+        self.assertIs(parse("01-02-2022 03:04:05"), parse("01-02-2022 03:04:05"))
+        for text in ("", "2022-01-02 03:04:05", "13-02-2022 03:04:05", "01-02-2022 03:04:05 +2500",
+                     "01-02-2022 03:04:05 UTC", "01-02-2022 03:04"):
+            self.assertRaises(ValueError, parse, text)
+
     def test_repr(self):
         """Test representation of a promotion"""
         promotion = PromotionFactory()
@@ -357,3 +413,208 @@ class TestPromotion(unittest.TestCase):
     def test_find_or_404_not_found(self):
         """Find or return 404 NOT found"""
         self.assertRaises(NotFound, Promotion.find_or_404, 0)
+
+    def test_paginate(self):
+        """Page through Promotions ordered by id"""
+        promotions = PromotionFactory.create_batch(5)
+        for promotion in promotions:
+            promotion.create()
+        page = Promotion.paginate(Promotion.query_all(), limit=2).all()
+        self.assertEqual([p.id for p in page], [promotions[0].id, promotions[1].id])
+        page = Promotion.paginate(Promotion.query_all(), after=page[-1].id, limit=2).all()
+        self.assertEqual([p.id for p in page], [promotions[2].id, promotions[3].id])
+        page = Promotion.paginate(Promotion.query_all(), after=page[-1].id).all()
+        self.assertEqual([p.id for p in page], [promotions[4].id])
+
+    def test_bulk_create(self):
+        """Create many Promotions in one transaction"""
+        promotions = PromotionFactory.build_batch(5)
+        ids = Promotion.bulk_create(promotions, batch_size=2)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(Promotion.all()), 5)
+        for promotion, promotion_id in zip(promotions, ids):
+            self.assertEqual(Promotion.find(promotion_id).name, promotion.name)
+        # later Promotions get ids after the reserved ones
+        promotion = PromotionFactory()
+        promotion.create()
+        self.assertGreater(promotion.id, max(ids))
+        self.assertEqual(Promotion.bulk_create([]), [])
+
+    def test_delete_and_invalidate_matching(self):
+        """Delete and invalidate Promotions with set-based statements"""
+        promotions = PromotionFactory.create_batch(3)
+        for promotion in promotions:
+            promotion.ongoing = True
+            promotion.create()
+        product_id = promotions[0].product_id
+        count = Promotion.invalidate_matching(Promotion.find_by_product_id(product_id))
+        self.assertEqual(count, 1)
+        self.assertFalse(Promotion.find(promotions[0].id).ongoing)
+        self.assertTrue(Promotion.find(promotions[1].id).ongoing)
+        count = Promotion.delete_matching(Promotion.find_by_product_id(product_id))
+        self.assertEqual(count, 1)
+        self.assertEqual(len(Promotion.all()), 2)
+
+    def _explain(self, query):
+        """Returns the query plan chosen for `query`"""
+        statement = query.statement.compile(dialect=db.engine.dialect)
+        connection = db.session.connection()
+        rows = connection.exec_driver_sql("EXPLAIN " + str(statement), statement.params)
+        return "\n".join(row[0] for row in rows)
+
+    def test_finders_use_indexes(self):
+        """Each finder is planned as an index lookup"""
+        Promotion.bulk_create(PromotionFactory.build_batch(20))
+        db.session.execute("ANALYZE promotion")
+        # the table is tiny, so make the planner prefer any usable index
+        db.session.execute("SET LOCAL enable_seqscan = off")
+        date = datetime(2022, 1, 15)
+        self.assertIn("ix_promotion_product_id_id", self._explain(Promotion.find_by_product_id(11)))
+        self.assertIn("ix_promotion_name_id", self._explain(Promotion.find_by_name("Summer Sale")))
+        self.assertIn("ix_promotion_active_window", self._explain(Promotion.find_by_start_date(date)))
+        self.assertIn("ix_promotion_active_window", self._explain(Promotion.find_active(date)))
+        query = Promotion.find_matching(product_ids=[11], active_on=date, ongoing=True)
+        self.assertIn("Index", self._explain(query))
+        # a keyset page of one product seeks past `after` without a sort
+        plan = self._explain(Promotion.paginate(Promotion.find_by_product_id(11), after=5, limit=10))
+        self.assertIn("ix_promotion_product_id_id", plan)
+        self.assertNotIn("Sort", plan)
+        plan = self._explain(Promotion.paginate(Promotion.find_by_name("Summer Sale"), after=5, limit=10))
+        self.assertIn("ix_promotion_name_id", plan)
+        self.assertNotIn("Sort", plan)
+        db.session.rollback()
+
+    def test_versions(self):
+        """Give every written row a new version"""
+        promotion = PromotionFactory()
+        promotion.create()
+        first = Promotion.version_of(promotion.id)
+        self.assertIsNotNone(first)
+        promotion.name = "renamed"
+        promotion.update()
+        self.assertGreater(Promotion.version_of(promotion.id), first)
+        ids = Promotion.bulk_create(PromotionFactory.build_batch(3))
+        self.assertEqual(len({Promotion.version_of(i) for i in ids}), 3)
+        self.assertIsNone(Promotion.version_of(-1))
+
+        page = Promotion.paginate(Promotion.query_all(), limit=2)
+        versions = Promotion.versions(page)
+        self.assertEqual(versions[0], 2)
+        # a write to a row outside the page leaves its versions alone
+        Promotion.invalidate_matching(Promotion.find_by_ids([ids[-1]]))
+        self.assertEqual(Promotion.versions(page), versions)
+        Promotion.invalidate_matching(Promotion.find_by_ids([ids[0]]))
+        self.assertNotEqual(Promotion.versions(page), versions)
+        self.assertEqual(Promotion.versions(Promotion.find_by_ids([-1])), (0, 0))
+
+    def test_create_columns_on_existing_table(self):
+        """Add the version column to a table created before it existed"""
+        PromotionFactory().create()
+        db.session.commit()
+        with db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE promotion DROP COLUMN version"))
+        Promotion.create_columns()
+        self.assertIsNotNone(Promotion.version_of(Promotion.all()[0].id))
+        # running it again is a no-op
+        Promotion.create_columns()
+
+    def test_create_indexes_on_existing_table(self):
+        """Add missing indexes to a table created before they existed"""
+        for index in Promotion.__table__.indexes:
+            index.drop(bind=db.engine)
+        self.assertEqual(inspect(db.engine).get_indexes("promotion"), [])
+        Promotion.create_indexes()
+        names = {index["name"] for index in inspect(db.engine).get_indexes("promotion")}
+        self.assertEqual(names, {index.name for index in Promotion.__table__.indexes})
+        # running it again is a no-op
+        Promotion.create_indexes()
+
+    def test_create_indexes_replaces_retired_and_invalid(self):
+        """Drop retired indexes and rebuild invalid ones"""
+        with db.engine.begin() as conn:
+            conn.execute(text("CREATE INDEX ix_promotion_name ON promotion (name)"))
+            # what an interrupted CREATE INDEX CONCURRENTLY leaves behind
+            conn.execute(text(
+                "UPDATE pg_index SET indisvalid = false"
+                " WHERE indexrelid = CAST('ix_promotion_name_id' AS regclass)"
+            ))
+        Promotion.create_indexes()
+        query = text(
+            "SELECT c.relname, i.indisvalid FROM pg_index i"
+            " JOIN pg_class c ON c.oid = i.indexrelid"
+            " WHERE i.indrelid = CAST('promotion' AS regclass)"
+        )
+        with db.engine.connect() as conn:
+            indexes = dict(conn.execute(query).fetchall())
+        self.assertNotIn("ix_promotion_name", indexes)
+        self.assertTrue(indexes["ix_promotion_name_id"])
+
+    def test_find_active(self):
+        """Find Promotions active on a date, including open-ended ones"""
+        Promotion(
+            name="Summer Sale",
+            start_date=datetime(2022, 6, 1),
+            end_date=datetime(2022, 9, 1),
+            type=Type.PERCENTAGE,
+            value=20.0,
+            ongoing=True,
+            product_id=11,
+        ).create()
+        Promotion(
+            name="Forever Sale",
+            start_date=datetime(2022, 1, 1),
+            end_date=None,
+            type=Type.VALUE,
+            value=5.0,
+            ongoing=True,
+            product_id=12,
+        ).create()
+        names = [p.name for p in Promotion.find_active(datetime(2022, 7, 1))]
+        self.assertEqual(sorted(names), ["Forever Sale", "Summer Sale"])
+        names = [p.name for p in Promotion.find_active("10-01-2022 00:00:00")]
+        self.assertEqual(names, ["Forever Sale"])
+        names = [p.name for p in Promotion.find_active(datetime(2022, 7, 1), 11)]
+        self.assertEqual(names, ["Summer Sale"])
+
+    def test_find_matching(self):
+        """Find Promotions matching several filters at once"""
+        for name, promotion_type, value, ongoing, product_id in (
+            ("Summer Sale", Type.PERCENTAGE, 20.0, True, 42),
+            ("Summer Sale", Type.VALUE, 5.0, True, 42),
+            ("Old Sale", Type.PERCENTAGE, 30.0, False, 42),
+            ("Summer Sale", Type.PERCENTAGE, 10.0, True, 43),
+        ):
+            Promotion(
+                name=name,
+                start_date=datetime(2022, 6, 1),
+                end_date=datetime(2022, 9, 1),
+                type=promotion_type,
+                value=value,
+                ongoing=ongoing,
+                product_id=product_id,
+            ).create()
+        find = Promotion.find_matching
+        self.assertEqual(find().count(), 4)
+        query = find(product_ids=[42], active_on=datetime(2022, 7, 1), promotion_type=Type.PERCENTAGE)
+        self.assertEqual(sorted(p.value for p in query), [20.0, 30.0])
+        query = find(product_ids=[42, 43], promotion_type=Type.PERCENTAGE, ongoing=True)
+        self.assertEqual(sorted(p.value for p in query), [10.0, 20.0])
+        query = find(name="Summer Sale", value_min=5.0, value_max=10.0)
+        self.assertEqual(sorted(p.value for p in query), [5.0, 10.0])
+        self.assertEqual(find(product_ids=[42], active_on=datetime(2022, 10, 1)).count(), 0)
+        self.assertEqual(find(ids=[], name="Summer Sale").count(), 0)
+
+    def test_count(self):
+        """Count Promotions exactly and from the planner statistics"""
+        promotions = PromotionFactory.build_batch(30)
+        for promotion in promotions[:10]:
+            promotion.product_id = 7
+        Promotion.bulk_create(promotions)
+        self.assertEqual(Promotion.count(Promotion.query_all()), 30)
+        self.assertEqual(Promotion.count(Promotion.find_by_product_id(7)), 10)
+        self.assertEqual(Promotion.count(Promotion.paginate(Promotion.query_all(), limit=5)), 30)
+        db.session.execute("ANALYZE promotion")
+        self.assertEqual(Promotion.estimate_count(Promotion.query_all()), 30)
+        estimate = Promotion.estimate_count(Promotion.find_matching(product_ids=[7], promotion_type=Type.VALUE))
+        self.assertGreaterEqual(estimate, 1)
+        self.assertLessEqual(estimate, 10)
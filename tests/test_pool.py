@@ -0,0 +1,85 @@
+"""
+Test cases for the connection pool statistics
+
+"""
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from service.pool import InstrumentedQueuePool, pool_stats
+
+
+######################################################################
+#  P O O L   S T A T S   T E S T   C A S E S
+######################################################################
+class TestPoolStats(unittest.TestCase):
+    """Test Cases for the instrumented connection pool"""
+
+    def setUp(self):
+        """Creates a pool of one connection that times out quickly"""
+        self.engine = create_engine(
+            "sqlite://",
+            poolclass=InstrumentedQueuePool,
+            pool_size=1,
+            max_overflow=1,
+            pool_timeout=0.05,
+        )
+        pool_stats.reset()
+        pool_stats.watch(self.engine)
+        # watching twice does not count twice
+        pool_stats.watch(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        pool_stats.reset()
+
+    def test_checkouts_and_overflow(self):
+        """Count checkouts and report connections in use"""
+        first = self.engine.connect()
+        second = self.engine.connect()
+        stats = pool_stats.stats(self.engine.pool)
+        self.assertEqual(stats["pool"], "InstrumentedQueuePool")
+        self.assertEqual(stats["size"], 1)
+        self.assertEqual(stats["checked_out"], 2)
+        self.assertEqual(stats["overflow"], 1)
+        self.assertEqual(stats["checkouts"], 2)
+        self.assertEqual(stats["connects"], 2)
+        second.close()
+        first.close()
+        stats = pool_stats.stats(self.engine.pool)
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertEqual(stats["checked_in"], 1)
+        # the overflow connection is closed when it comes back
+        self.assertEqual(stats["closes"], 1)
+
+    def test_timeouts(self):
+        """Count checkouts that time out waiting for a connection"""
+        connections = [self.engine.connect(), self.engine.connect()]
+        self.assertRaises(PoolTimeoutError, self.engine.connect)
+        stats = pool_stats.stats(self.engine.pool)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertGreaterEqual(stats["wait_seconds"]["max"], 0.05)
+        for connection in connections:
+            connection.close()
+
+    def test_wait_histogram(self):
+        """Sort waits into cumulative buckets"""
+        for seconds in (0.0005, 0.002, 0.2, 60.0):
+            pool_stats.record_wait(seconds)
+        waits = pool_stats.stats(self.engine.pool)["wait_seconds"]
+        self.assertEqual(waits["count"], 4)
+        self.assertAlmostEqual(waits["sum"], 60.2025)
+        self.assertEqual(waits["max"], 60.0)
+        self.assertEqual(waits["buckets"]["0.001"], 1)
+        self.assertEqual(waits["buckets"]["0.005"], 2)
+        self.assertEqual(waits["buckets"]["0.5"], 3)
+        self.assertEqual(waits["buckets"]["30.0"], 3)
+        self.assertEqual(waits["buckets"]["+Inf"], 4)
+
+    def test_invalidations(self):
+        """Count connections that are invalidated"""
+        connection = self.engine.connect()
+        connection.invalidate()
+        connection.close()
+        self.assertEqual(pool_stats.stats(self.engine.pool)["invalidations"], 1)
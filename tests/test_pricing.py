@@ -0,0 +1,55 @@
+"""
+Test cases for the cart pricing engine
+
+"""
+import unittest
+
+from service.models import Type
+from service.pricing import CartLine, best_offers, price_lines
+
+from .factories import PromotionFactory
+
+
+######################################################################
+#  P R I C I N G   T E S T   C A S E S
+######################################################################
+class TestPricing(unittest.TestCase):
+    """Test Cases for the pricing engine"""
+
+    def setUp(self):
+        self.promotions = [
+            PromotionFactory(id=1, product_id=1, type=Type.VALUE, value=5.0),
+            PromotionFactory(id=2, product_id=1, type=Type.VALUE, value=8.0),
+            PromotionFactory(id=3, product_id=1, type=Type.PERCENTAGE, value=10.0),
+            PromotionFactory(id=4, product_id=2, type=Type.PERCENTAGE, value=50.0),
+            PromotionFactory(id=5, product_id=2, type=Type.UNKNOWN, value=99.0),
+            PromotionFactory(id=6, product_id=3, type=Type.VALUE, value=30.0),
+        ]
+
+    def test_best_offers(self):
+        """Keep the largest offer of each type per product"""
+        offers = best_offers(self.promotions)
+        self.assertEqual(offers[1], ((8.0, 2), (10.0, 3)))
+        self.assertEqual(offers[2], ((0.0, None), (50.0, 4)))
+        self.assertEqual(offers[3], ((30.0, 6), (0.0, None)))
+
+    def test_price_lines(self):
+        """Give each line the promotion that saves the most"""
+        lines = [
+            CartLine(1, 50.0, 2),   # 8 off beats 10% (5)
+            CartLine(1, 100.0, 1),  # 10% (10) beats 8 off
+            CartLine(2, 20.0, 3),   # 50% off
+            CartLine(3, 20.0, 1),   # 30 off is capped at the price
+            CartLine(4, 10.0, 1),   # no promotion
+        ]
+        priced = price_lines(lines, self.promotions)
+        self.assertEqual([line.promotion_id for line in priced], [2, 3, 4, 6, None])
+        self.assertEqual([line.discount for line in priced], [8.0, 10.0, 10.0, 20.0, 0.0])
+        self.assertEqual([line.total for line in priced], [84.0, 90.0, 30.0, 0.0, 10.0])
+        self.assertEqual(priced[0].subtotal, 100.0)
+
+    def test_price_empty_cart(self):
+        """Price a cart without lines or promotions"""
+        self.assertEqual(price_lines([], self.promotions), [])
+        priced = price_lines([CartLine(1, 10.0, 1)], [])
+        self.assertEqual(priced[0].total, 10.0)
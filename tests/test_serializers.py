@@ -0,0 +1,69 @@
+"""
+Test cases for the fast Promotion serializer
+
+"""
+import json
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from service.models import Promotion
+from service.serializers import encode_dict, encode_list, encode_row, format_datetime, row_encoder
+
+from .factories import PromotionFactory
+
+
+def as_row(promotion):
+    """Returns the row of a Promotion the way Promotion.as_rows() does"""
+    return tuple(getattr(promotion, field) for field in Promotion.ROW_FIELDS)
+
+
+######################################################################
+#  S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+class TestSerializers(unittest.TestCase):
+    """Test Cases for the fast serializer"""
+
+    def test_format_datetime(self):
+        """Format dates exactly like strftime"""
+        for date in (
+            datetime(2022, 1, 2, 3, 4, 5),
+            datetime(2022, 12, 31, 23, 59, 59, 999999),
+            datetime(2022, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+            datetime(2022, 1, 2, 3, 4, 5, tzinfo=timezone(timedelta(hours=-4))),
+            datetime(2022, 1, 2, 3, 4, 5, tzinfo=timezone(timedelta(hours=5, minutes=30))),
+            datetime(2022, 1, 2, 3, 4, 5, tzinfo=timezone(timedelta(seconds=3601))),
+        ):
+            self.assertEqual(format_datetime(date), date.strftime("%m-%d-%Y %H:%M:%S %z"))
+
+    def test_encode_row(self):
+        """Encode rows with the same values as Promotion.serialize"""
+        for promotion in PromotionFactory.build_batch(20):
+            self.assertEqual(json.loads(encode_row(as_row(promotion))), promotion.serialize())
+
+    def test_encode_special_row(self):
+        """Encode rows without an end date, with integer values and odd names"""
+        promotion = PromotionFactory(
+            name='Sale "50%" \\ naïve', end_date=None, value=3, ongoing=False
+        )
+        data = json.loads(encode_row(as_row(promotion)))
+        self.assertEqual(data, promotion.serialize())
+        self.assertIsInstance(data["value"], float)
+
+    def test_row_encoder(self):
+        """Encode rows of a projection with only its fields"""
+        self.assertIs(row_encoder(Promotion.ROW_FIELDS), encode_row)
+        fields = ("product_id", "end_date", "type", "ongoing", "value", "name", "start_date")
+        encode = row_encoder(fields)
+        for promotion in PromotionFactory.build_batch(5) + [PromotionFactory.build(end_date=None)]:
+            row = tuple(getattr(promotion, field) for field in fields)
+            expected = {field: promotion.serialize()[field] for field in fields}
+            self.assertEqual(json.loads(encode(row)), expected)
+            # columns after the fields, such as the cursor id, are left out
+            self.assertEqual(json.loads(encode(row + (promotion.id,))), expected)
+
+    def test_encode_list(self):
+        """Join encoded Promotions into an array"""
+        promotions = PromotionFactory.build_batch(3)
+        text = encode_list([encode_row(as_row(promotions[0]))] + [encode_dict(p.serialize()) for p in promotions[1:]])
+        self.assertEqual(json.loads(text), [p.serialize() for p in promotions])
+        self.assertEqual(encode_list([]), "[]")